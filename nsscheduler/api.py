@@ -1,58 +1,266 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import hashlib
+import logging
+import re
+from bisect import bisect_right
 
-from nsscheduler import scheduler
-from nsscheduler.data_models.api import EnvStateResponse, StateAllResponse
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+
+from nsscheduler import scheduler, updown
+from nsscheduler.data_models.api import (
+    BulkActionRequest,
+    BulkActionResponse,
+    BulkActionResult,
+    BulkActionStatus,
+    CacheStatsResponse,
+    EnvironmentState,
+    EnvStateResponse,
+    EnvSummaryResponse,
+    StateAllResponse,
+)
+from nsscheduler.data_models.scheduler_config import Schedule
 from nsscheduler.scheduler import (
     ActionType,
     AnotherActionIsInProgressException,
+    EnvironmentSchedulerException,
     ManualActionIsAlreadyScheduled,
     WrongEnvNameException,
 )
+from nsscheduler.state_stream import StateBroadcaster, StateVersions, encode_json
 
 app = FastAPI()
+state_versions = StateVersions()
+# Shares the versions with /state_all, so that a client may switch from the stream to `since` requests
+state_broadcaster = StateBroadcaster(scheduler.get_all_env_states, state_versions)
+# JSON of the schedules, they do not change at runtime
+schedules_payload: bytes | None = None
+
+
+def _etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def _select_env_states(
+    env_names: list[str], env_state: EnvironmentState | None, limit: int | None
+) -> tuple[list[EnvStateResponse], str | None]:
+    """
+    Returns a page of at most `limit` states of the environments being in `env_state` and the name of the last one if
+    there are more environments to look at. States are computed only for the environments up to the end of the page.
+    """
+    page: list[EnvStateResponse] = []
+    index = 0
+    while index < len(env_names) and (limit is None or len(page) < limit):
+        chunk = env_names[index:] if limit is None else env_names[index : index + limit - len(page)]
+        index += len(chunk)
+        page.extend(state for state in await scheduler.get_env_states(chunk) if env_state in (None, state.env_state))
+    continue_ = page[-1].env_name if page and index < len(env_names) else None
+    return page, continue_
 
 
 @app.get("/state_all", response_model=StateAllResponse, tags=["state"])
-async def get_state_of_namespaces_in_all_env():
-    return await scheduler.get_all_env_states()
+async def get_state_of_namespaces_in_all_env(
+    since: int | None = None,
+    name_prefix: str | None = None,
+    name_regex: str | None = None,
+    schedule: str | None = None,
+    state: EnvironmentState | None = None,
+    limit: int | None = Query(None, gt=0),
+    continue_: str | None = Query(None, alias="continue"),
+    summary: bool = False,
+    if_none_match: str | None = Header(None),
+):
+    """
+    Returns states of the environments ordered by name. Environments may be filtered by name prefix, name regex,
+    schedule and state, and paginated with `limit` and `continue` (taken from the previous page). With `summary`,
+    per-namespace rows are replaced by totals.
+
+    The response carries an ETag, so it may be requested conditionally with If-None-Match. With `since`, only the
+    environments changed after that version are returned.
+    """
+    try:
+        env_names = scheduler.list_env_names(name_prefix, name_regex, schedule)
+    except re.error as e:
+        raise HTTPException(status_code=422, detail=f"Invalid name_regex: {str(e)}")
+    if continue_ is not None:
+        env_names = env_names[bisect_right(env_names, continue_) :]
+
+    env_states, next_continue = await _select_env_states(env_names, state, limit)
+    state_versions.update(env_states)
+    version = max((env_state.version for env_state in env_states), default=0)
+    # `since` is hashed as well: the delta and the full response of the same page are different representations
+    page_hash = hashlib.sha256(
+        repr(
+            (since, summary, next_continue, [(env_state.env_name, env_state.version) for env_state in env_states])
+        ).encode()
+    )
+    etag = f'"{page_hash.hexdigest()[:16]}"'
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    env_states = [env_state for env_state in env_states if since is None or env_state.version > since]
+    if summary:
+        payloads = [encode_json(EnvSummaryResponse.from_env_state(env_state).dict()) for env_state in env_states]
+    else:
+        # States are encoded once per version, the response is assembled from the encoded ones
+        payloads = [state_versions.payload(env_state.env_name) for env_state in env_states]
+    content = (
+        b'{"environments":['
+        + b",".join(payloads)
+        + b'],"version":'
+        + str(version).encode()
+        + b',"continue":'
+        + encode_json(next_continue)
+        + b"}"
+    )
+    return Response(content=content, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/state_stream", tags=["state"])
+async def stream_state_of_all_envs(request: Request):
+    """
+    Server-sent events stream. Every `env_state` event carries an EnvStateResponse: first for all the environments and
+    then for every environment whose state has changed.
+    """
+
+    async def events():
+        async for payloads in state_broadcaster.subscribe():
+            if await request.is_disconnected():
+                break
+            if not payloads:
+                yield b": keepalive\n\n"
+            for payload in payloads:
+                yield b"event: env_state\ndata: " + payload + b"\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 @app.get("/state/{env_name}", response_model=EnvStateResponse, tags=["state"])
-async def get_state_of_namespaces_in_env(env_name: str):
+async def get_state_of_namespaces_in_env(env_name: str, if_none_match: str | None = Header(None)):
     try:
-        return await scheduler.get_env_state(env_name)
+        env_state = await scheduler.get_env_state(env_name)
     except WrongEnvNameException:
         raise HTTPException(status_code=422, detail="There are no environments with such name")
 
+    state_versions.update([env_state])
+    etag = _etag(env_state.version)
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=state_versions.payload(env_name), media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/schedules", response_model=dict[str, Schedule], tags=["state"])
+async def get_schedules(if_none_match: str | None = Header(None)):
+    """Returns schedules referenced by the environment states. Schedules change only when the scheduler restarts"""
+    global schedules_payload
+    if schedules_payload is None:
+        schedules_payload = encode_json(
+            {name: schedule.dict(by_alias=True) for name, schedule in scheduler.get_schedules().items()}
+        )
+    etag = f'"{hashlib.sha256(schedules_payload).hexdigest()[:16]}"'
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=schedules_payload, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/stats/ns_state_cache", response_model=CacheStatsResponse, tags=["stats"])
+async def get_ns_state_cache_stats():
+    stats = updown.ns_state_cache.stats()
+    return CacheStatsResponse(size=len(updown.ns_state_cache), **vars(stats))
+
 
 # TODO:
 #   Maybe addd smart system for queueing ups and downs for spam protection.
 #   Probably can instead add non-200 responses to indicate that namespace\env is in process of shutting down\starting up
 #   and can't be acted upon right now
-def process_action_request(env_name: str, action_type: scheduler.ActionType):
+async def process_action_request(env_name: str, action_type: scheduler.ActionType):
     try:
-        scheduler.add_manual_action_to_queue(env_name, action_type)
-    except WrongEnvNameException:
-        raise HTTPException(status_code=422, detail="There are no environments with such name")
-    except AnotherActionIsInProgressException:
-        raise HTTPException(
+        await scheduler.add_manual_action_to_queue(env_name, action_type)
+    except EnvironmentSchedulerException as e:
+        raise _action_error(e)
+
+
+def _action_error(e: EnvironmentSchedulerException) -> HTTPException:
+    if isinstance(e, WrongEnvNameException):
+        return HTTPException(status_code=422, detail="There are no environments with such name")
+    if isinstance(e, AnotherActionIsInProgressException):
+        return HTTPException(
             status_code=409,
             detail="Another action is in progress. "
             "Can't schedule manual actions while another action is in progress",
         )
-    except ManualActionIsAlreadyScheduled:
-        raise HTTPException(
+    if isinstance(e, ManualActionIsAlreadyScheduled):
+        return HTTPException(
             status_code=409,
             detail="Manual action is already scheduled but not completed. "
             "Can't schedule more then one manual action",
         )
+    return HTTPException(status_code=500, detail=str(e))
+
+
+async def process_bulk_action_request(
+    request: BulkActionRequest, action_type: scheduler.ActionType
+) -> BulkActionResponse:
+    """
+    Schedules the action for every selected environment and returns per-environment results. States of all the
+    environments are computed at once from a shared snapshot. Only STOP skips environments (the ones already shut
+    down): an environment reported UP may be up only partially, so START is scheduled for all of them. The response
+    is returned once the actions are queued, they are run through the capacity gate and the admission queue like any
+    other ones.
+    """
+    if request.env_names is not None:
+        env_names = list(dict.fromkeys(request.env_names))
+    else:
+        try:
+            env_names = scheduler.list_env_names(request.name_prefix, request.name_regex, request.schedule)
+        except re.error as e:
+            raise HTTPException(status_code=422, detail=f"Invalid name_regex: {str(e)}")
+
+    known_env_names = set(scheduler.list_env_names())
+    env_states = {
+        env_state.env_name: env_state.env_state
+        for env_state in await scheduler.get_env_states([name for name in env_names if name in known_env_names])
+    }
+
+    async def act(env_name: str) -> BulkActionResult:
+        if action_type == ActionType.STOP and env_states.get(env_name) == EnvironmentState.DOWN:
+            return BulkActionResult(env_name=env_name, status=BulkActionStatus.SKIPPED)
+        try:
+            # Actions are only queued: waiting for every one of them to be admitted could take longer than the request
+            await scheduler.add_manual_action_to_queue(env_name, action_type, wait_started=False)
+        except EnvironmentSchedulerException as e:
+            return BulkActionResult(env_name=env_name, status=BulkActionStatus.FAILED, detail=_action_error(e).detail)
+        except Exception as e:
+            # A failure of one environment must not hide the results of the others
+            logging.error(f"Failed to schedule action for env {env_name}: {str(e)}")
+            return BulkActionResult(env_name=env_name, status=BulkActionStatus.FAILED, detail=str(e))
+        return BulkActionResult(env_name=env_name, status=BulkActionStatus.SCHEDULED)
+
+    return BulkActionResponse(results=await asyncio.gather(*[act(env_name) for env_name in env_names]))
 
 
 @app.post("/up/{env_name}", tags=["action"])
 async def start_up_the_environment(env_name: str):
-    process_action_request(env_name, ActionType.START)
+    await process_action_request(env_name, ActionType.START)
 
 
 @app.post("/down/{env_name}", tags=["action"])
 async def shut_down_the_environment(env_name: str):
-    process_action_request(env_name, ActionType.STOP)
+    await process_action_request(env_name, ActionType.STOP)
+
+
+@app.post("/bulk/up", response_model=BulkActionResponse, tags=["action"])
+async def start_up_environments(request: BulkActionRequest):
+    return await process_bulk_action_request(request, ActionType.START)
+
+
+@app.post("/bulk/down", response_model=BulkActionResponse, tags=["action"])
+async def shut_down_environments(request: BulkActionRequest):
+    return await process_bulk_action_request(request, ActionType.STOP)
@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import logging
+import time
+from decimal import Decimal
+
+import kubernetes
+from kubernetes.utils.quantity import parse_quantity
+
+from nsscheduler.rate_limit import call_api
+from nsscheduler.updown import run_blocking
+
+# (cpu in cores, memory in bytes)
+Resources = tuple[Decimal, Decimal]
+
+
+def _sum_requests(containers) -> Resources:
+    cpu = Decimal(0)
+    memory = Decimal(0)
+    for c in containers or []:
+        if c.resources and c.resources.requests:
+            cpu += parse_quantity(c.resources.requests.get("cpu", 0))
+            memory += parse_quantity(c.resources.requests.get("memory", 0))
+    return cpu, memory
+
+
+def get_free_resources() -> Resources:
+    """
+    Returns allocatable resources of the schedulable nodes minus requests of the pods, which are not terminated yet.
+    Pending pods are counted as well, as they are going to take the resources once scheduled.
+    """
+    v1 = kubernetes.client.CoreV1Api()
+    allocatable_cpu = Decimal(0)
+    allocatable_memory = Decimal(0)
+    for node in call_api(v1.list_node).items:
+        if node.spec.unschedulable or not node.status.allocatable:
+            continue
+        allocatable_cpu += parse_quantity(node.status.allocatable.get("cpu", 0))
+        allocatable_memory += parse_quantity(node.status.allocatable.get("memory", 0))
+
+    requested_cpu = Decimal(0)
+    requested_memory = Decimal(0)
+    pods = call_api(
+        v1.list_pod_for_all_namespaces, field_selector="status.phase!=Succeeded,status.phase!=Failed", watch=False
+    )
+    for pod in pods.items:
+        cpu, memory = _sum_requests(pod.spec.containers)
+        requested_cpu += cpu
+        requested_memory += memory
+
+    return allocatable_cpu - requested_cpu, allocatable_memory - requested_memory
+
+
+class Reservation:
+    """Resources reserved for an admitted scale-up. They are released as its pods get created."""
+
+    def __init__(self, gate: "CapacityGate", cpu: Decimal, memory: Decimal) -> None:
+        self._gate = gate
+        self.cpu = cpu
+        self.memory = memory
+
+    def release(self, cpu: Decimal, memory: Decimal) -> None:
+        """
+        Releases (at most the remaining) part of the reservation, e.g. once a workload is scaled up: its pods are
+        counted in the listed requests from then on, so keeping them reserved would count them twice
+        """
+        cpu = min(cpu, self.cpu)
+        memory = min(memory, self.memory)
+        if cpu <= 0 and memory <= 0:
+            return
+        self.cpu -= cpu
+        self.memory -= memory
+        self._gate._release(cpu, memory)
+
+
+class CapacityGate:
+    """
+    Admits scale-ups only when the cluster has enough free resources for them.
+
+    Resources of the admitted scale-ups are reserved until their pods are created, so that environments starting at the
+    same moment do not count on the same free resources. A scale-up, which does not fit, waits for the resources to be
+    released (while smaller ones, which do fit, go ahead) and is admitted anyway after `max_wait` seconds: the cluster
+    autoscaler may add nodes only when it sees pending pods.
+    """
+
+    def __init__(self, max_wait: float, poll_period: float = 30, free_resources_ttl: float = 5) -> None:
+        """
+        :param max_wait: maximum time in seconds a scale-up waits for resources, 0 disables the check
+        :param poll_period: free resources are re-checked at least that often while waiting
+        :param free_resources_ttl: free resources are listed at most once in that number of seconds
+        """
+        self.max_wait = max_wait
+        self.poll_period = poll_period
+        self.free_resources_ttl = free_resources_ttl
+        self._reserved_cpu = Decimal(0)
+        self._reserved_memory = Decimal(0)
+        self._free: Resources | None = None
+        self._free_updated_at = 0.0
+        # Set (and replaced with a new one) every time reserved resources are released
+        self._released: asyncio.Event | None = None
+
+    async def _get_free_resources(self) -> Resources:
+        if self._free is None or self._free_updated_at + self.free_resources_ttl < time.monotonic():
+            self._free = await run_blocking(get_free_resources)
+            self._free_updated_at = time.monotonic()
+        return self._free
+
+    async def _fits(self, cpu: Decimal, memory: Decimal) -> bool:
+        free_cpu, free_memory = await self._get_free_resources()
+        return cpu <= free_cpu - self._reserved_cpu and memory <= free_memory - self._reserved_memory
+
+    def _release(self, cpu: Decimal, memory: Decimal) -> None:
+        self._reserved_cpu -= cpu
+        self._reserved_memory -= memory
+        # The released resources are either free or taken by the created pods, which the next listing accounts for
+        self._free = None
+        if self._released is not None:
+            self._released.set()
+            self._released = asyncio.Event()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, name: str, cpu: Decimal, memory: Decimal):
+        """Waits until the resources fit and yields their Reservation, the rest of which is released on exit"""
+        if self.max_wait <= 0 or (cpu <= 0 and memory <= 0):
+            yield Reservation(self, Decimal(0), Decimal(0))
+            return
+
+        if self._released is None:
+            self._released = asyncio.Event()
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while not await self._fits(cpu, memory):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.warning(
+                        f"Cluster has no free resources for {name} ({cpu} CPU, {memory} bytes of memory) after "
+                        f"{self.max_wait} seconds, starting it anyway"
+                    )
+                    break
+                logging.info(f"Waiting for free resources for {name} ({cpu} CPU, {memory} bytes of memory)")
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._released.wait(), min(self.poll_period, remaining))
+        except Exception as e:
+            logging.error(f"Failed to check free resources for {name}, starting it anyway: {str(e)}")
+
+        self._reserved_cpu += cpu
+        self._reserved_memory += memory
+        reservation = Reservation(self, cpu, memory)
+        try:
+            yield reservation
+        finally:
+            reservation.release(reservation.cpu, reservation.memory)
@@ -15,6 +15,7 @@ from nsscheduler.data_models.api import (
     EnvStateResponse,
     StateAllResponse,
 )
+from nsscheduler.data_models.scheduler_config import Schedule
 
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], title="ns-scheduler dashboard")
 
@@ -53,7 +54,9 @@ def generate_env_subtable(env_state_response: EnvStateResponse) -> list[html.Tr]
                                         chain(
                                             *[
                                                 (line, html.Br())
-                                                for line in str(env_state_response.env_schedule).split("\n")
+                                                for line in str(get_schedule(env_state_response.schedule_name)).split(
+                                                    "\n"
+                                                )
                                             ]
                                         )
                                     )
@@ -162,6 +165,19 @@ def build_app_layout() -> html.Div:
     )
 
 
+# Schedules don't change while the scheduler is running, so they are requested once
+schedules: dict[str, Schedule] = {}
+
+
+def get_schedule(schedule_name: str) -> Schedule | None:
+    global schedules
+    if schedule_name not in schedules:
+        logging.debug("Requesting schedules")
+        response = requests.get(f"{base_url}/schedules").json()
+        schedules = {name: Schedule(**schedule) for name, schedule in response.items()}
+    return schedules.get(schedule_name)
+
+
 # Cache env states
 env_state_lifetime = float(4)
 env_states = {}
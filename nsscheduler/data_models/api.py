@@ -1,9 +1,8 @@
 from enum import Enum
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, root_validator
 
 from nsscheduler.data_models.internal import Action, NamespaceState
-from nsscheduler.data_models.scheduler_config import Schedule
 
 
 class EnvironmentState(str, Enum):
@@ -20,10 +19,86 @@ class NamespaceStateResponse(BaseModel):
 class EnvStateResponse(BaseModel):
     env_name: str
     env_state: EnvironmentState
-    env_schedule: Schedule
+    # Name of the schedule, schedules are served by /schedules
+    schedule_name: str
     next_action: Action | None
     namespaces: list[NamespaceStateResponse]
+    # Increased every time the state of the environment changes
+    version: int = 0
+
+
+class EnvSummaryResponse(BaseModel):
+    """State of an environment without per-namespace rows"""
+
+    env_name: str
+    env_state: EnvironmentState
+    schedule_name: str
+    next_action: Action | None
+    pods: int
+    cpu: float
+    memory: float
+    version: int = 0
+
+    @classmethod
+    def from_env_state(cls, env_state: EnvStateResponse) -> "EnvSummaryResponse":
+        return cls(
+            env_name=env_state.env_name,
+            env_state=env_state.env_state,
+            schedule_name=env_state.schedule_name,
+            next_action=env_state.next_action,
+            pods=sum(namespace.state.pods for namespace in env_state.namespaces),
+            cpu=sum(namespace.state.cpu for namespace in env_state.namespaces),
+            memory=sum(namespace.state.memory for namespace in env_state.namespaces),
+            version=env_state.version,
+        )
 
 
 class StateAllResponse(BaseModel):
-    environments: list[EnvStateResponse]
+    environments: list[EnvStateResponse | EnvSummaryResponse]
+    # Version of the latest change. Pass it as `since` to get only the environments changed after it
+    version: int = 0
+    # Pass it as `continue` to get the next page, None on the last page
+    continue_: str | None = Field(None, alias="continue")
+
+
+class CacheStatsResponse(BaseModel):
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+
+
+class BulkActionRequest(BaseModel):
+    """Environments to act upon: either a list of names or filters, which are ANDed"""
+
+    env_names: list[str] | None = None
+    name_prefix: str | None = None
+    name_regex: str | None = None
+    schedule: str | None = None
+
+    @root_validator(skip_on_failure=True)
+    def check_selectors(cls, values):
+        has_filters = any(values.get(key) is not None for key in ("name_prefix", "name_regex", "schedule"))
+        if (values.get("env_names") is not None) == has_filters:
+            raise ValueError("Either env_names or at least one of name_prefix, name_regex, schedule must be given")
+        return values
+
+
+class BulkActionStatus(str, Enum):
+    SCHEDULED = "scheduled"
+    # STOP of an environment, which is already down. START is never skipped: an environment is reported UP as soon as
+    # any of its namespaces is up, so it may still have workloads to start
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+class BulkActionResult(BaseModel):
+    env_name: str
+    status: BulkActionStatus
+    # Reason of the failure, the same as the one returned by /up/{env_name} and /down/{env_name}
+    detail: str | None = None
+
+
+class BulkActionResponse(BaseModel):
+    results: list[BulkActionResult]
@@ -1,8 +1,11 @@
 from collections import defaultdict
 from datetime import datetime, time, tzinfo
+from decimal import Decimal
+from enum import Enum
 from typing import Sequence
 
 from dateutil import parser
+from kubernetes.utils.quantity import parse_quantity
 from pydantic import BaseModel, Field, root_validator, validator
 from pytz import timezone
 
@@ -117,21 +120,59 @@ class Schedule(BaseModel):
         )
 
 
+class BatchMode(str, Enum):
+    # Wait `timeout` seconds between batches
+    TIMEOUT = "timeout"
+    # Start the next batch as soon as the workloads of the previous one are ready, but wait no longer than `timeout`
+    READINESS = "readiness"
+
+
 class BatchConfig(BaseModel):
-    size: int
+    # Maximum number of workloads in a batch, 0 means no limit
+    size: int = 0
     timeout: int
+    # Maximum sum of CPU and memory requests of the pods started by a batch. Kubernetes quantities, e.g. "8", "500m",
+    # "64Gi". A workload exceeding the budget alone is started in a batch of its own
+    cpu: Decimal | None = None
+    memory: Decimal | None = None
+    mode: BatchMode = BatchMode.TIMEOUT
+
+    @validator("cpu", "memory", pre=True)
+    def parse_resource_quantity(cls, quantity):
+        if quantity is not None:
+            quantity = parse_quantity(quantity)
+            assert quantity > 0, f"Batch resource budget must be positive, got {quantity} instead."
+        return quantity
+
+    @root_validator(pre=False, skip_on_failure=True)
+    def validate_limits(cls, field_values):
+        assert (
+            field_values["size"] > 0 or field_values["cpu"] is not None or field_values["memory"] is not None
+        ), "Batch must be limited by size, cpu or memory."
+        return field_values
 
 
 class Environment(BaseModel):
     namespaces: list[str]
     schedule: str
     batch: BatchConfig | None = None
+    # Number of workloads scaled in parallel. Namespace patterns are still processed one after another
+    concurrency: int = 1
+    # Start the environment ahead of the scheduled START by the (measured) time it takes to become ready, so that it is
+    # ready at the scheduled time. The lead is capped by ready_by_max_lead seconds
+    ready_by: bool = False
+    ready_by_max_lead: int = 1800
 
     @validator("namespaces")
     def validate_namespaces(cls, namespaces):
         assert len(namespaces) > 0, "At least one namespace must be specified in each environment."
         return namespaces
 
+    @validator("concurrency")
+    def validate_concurrency(cls, concurrency):
+        assert concurrency >= 1, f"Concurrency must be positive, got {concurrency} instead."
+        return concurrency
+
 
 class Config(BaseModel):
     schedules: dict[str, Schedule]
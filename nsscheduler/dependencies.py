@@ -0,0 +1,83 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+
+# Comma-separated list of workloads, which have to be ready before the annotated one is started. Workloads are
+# referenced as "name" (in the same namespace) or "namespace/name"
+depends_on_annotation = "ns.scheduler/depends-on"
+# Integer. Workloads of a tier are started once all workloads of the previous tier are ready. Defaults to 0
+tier_annotation = "ns.scheduler/tier"
+
+
+class DependencyCycleException(Exception):
+    pass
+
+
+@dataclass
+class WorkloadNode:
+    key: str
+    namespace: str
+    name: str
+    annotations: dict[str, str]
+
+    @property
+    def tier(self) -> int:
+        try:
+            return int(self.annotations.get(tier_annotation, 0))
+        except ValueError:
+            logging.warning(f"Ignoring invalid {tier_annotation} annotation of {self.key}")
+            return 0
+
+
+def has_dependency_annotations(annotations: dict[str, str] | None) -> bool:
+    return bool(annotations) and (depends_on_annotation in annotations or tier_annotation in annotations)
+
+
+def build_dependency_graph(nodes: list[WorkloadNode]) -> dict[str, set[str]]:
+    """
+    Builds startup dependency graph from the workloads' annotations.
+
+    :return: {workload key: keys of the workloads it depends on}
+    :raises DependencyCycleException: if dependencies form a cycle
+    """
+    dependencies: dict[str, set[str]] = {node.key: set() for node in nodes}
+
+    # Every tier depends on the closest lower one (and so transitively on all lower tiers)
+    tiers: dict[int, list[str]] = defaultdict(list)
+    for node in nodes:
+        tiers[node.tier].append(node.key)
+    sorted_tiers = sorted(tiers)
+    for lower_tier, tier in zip(sorted_tiers, sorted_tiers[1:]):
+        for key in tiers[tier]:
+            dependencies[key].update(tiers[lower_tier])
+
+    # The same name may be shared by a Deployment and a StatefulSet, both of them are dependencies then
+    by_reference: dict[tuple[str, str], list[str]] = defaultdict(list)
+    for node in nodes:
+        by_reference[(node.namespace, node.name)].append(node.key)
+    for node in nodes:
+        for reference in node.annotations.get(depends_on_annotation, "").split(","):
+            reference = reference.strip()
+            if not reference:
+                continue
+            namespace, _, name = reference.rpartition("/")
+            targets = by_reference.get((namespace or node.namespace, name))
+            if not targets:
+                logging.warning(f"{node.key} depends on unknown workload '{reference}', ignoring")
+                continue
+            dependencies[node.key].update(target for target in targets if target != node.key)
+
+    _check_acyclic(dependencies)
+    return dependencies
+
+
+def _check_acyclic(dependencies: dict[str, set[str]]) -> None:
+    remaining = {key: set(keys) for key, keys in dependencies.items()}
+    while remaining:
+        independent = [key for key, keys in remaining.items() if not keys]
+        if not independent:
+            raise DependencyCycleException(f"Startup dependencies form a cycle among {sorted(remaining)}")
+        for key in independent:
+            del remaining[key]
+        for keys in remaining.values():
+            keys.difference_update(independent)
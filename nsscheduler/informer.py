@@ -0,0 +1,194 @@
+import logging
+import threading
+from typing import Callable
+
+import kubernetes
+from kubernetes.client.exceptions import ApiException
+
+HTTP_STATUS_GONE = 410
+
+
+def _add(total: tuple | None, summary: tuple) -> tuple:
+    return summary if total is None else tuple(a + b for a, b in zip(total, summary))
+
+
+def _subtract(total: tuple, summary: tuple) -> tuple:
+    return tuple(a - b for a, b in zip(total, summary))
+
+
+class Informer:
+    """
+    Keeps a local copy of all kubernetes objects of one kind, indexed by namespace.
+
+    The store is filled by a single list call and then kept up to date by a watch, which is run in a daemon thread.
+    When the watch fails because the resourceVersion it was started from has expired (410 Gone), the informer
+    re-lists the objects and starts watching again from the new resourceVersion.
+
+    Cluster-scoped objects (e.g. namespaces) are stored under the `None` namespace.
+
+    Optionally the informer maintains per-namespace totals of object summaries (see `totals`). Summaries are computed
+    once per resourceVersion of an object and the totals are updated by the difference when the object changes.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        list_func: Callable,
+        watch_timeout: int = 300,
+        retry_period: float = 5,
+        summarize: Callable[[object], tuple] | None = None,
+    ) -> None:
+        """
+        :param kind: kind of the objects, used for logging only
+        :param list_func: cluster-wide list function of the kubernetes client,
+            e.g. `AppsV1Api().list_deployment_for_all_namespaces`
+        :param watch_timeout: server-side timeout of a single watch request in seconds
+        :param retry_period: delay in seconds before reconnecting after an unexpected error
+        :param summarize: returns a tuple of numbers for an object. If provided, element-wise sums of the tuples are
+            maintained per namespace
+        """
+        self.kind = kind
+        self._list_func = list_func
+        self._watch_timeout = watch_timeout
+        self._retry_period = retry_period
+        self._store: dict[str | None, dict[str, object]] = {}
+        self._summarize = summarize
+        # {(namespace, name): (resourceVersion, summary)}
+        self._summaries: dict[tuple[str | None, str], tuple[str, tuple]] = {}
+        self._totals: dict[str | None, tuple] = {}
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._resource_version: str | None = None
+        # Incremented every time an object is added to or removed from the store (but not when one is modified)
+        self.generation = 0
+        self._watch: kubernetes.watch.Watch | None = None
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        """Starts list+watch in a background thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f"{self.kind}-informer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+    def has_synced(self) -> bool:
+        """Returns True once the initial list has been loaded into the store"""
+        return self._synced.is_set()
+
+    def wait_for_sync(self, timeout: float | None = None) -> bool:
+        return self._synced.wait(timeout)
+
+    def list(self, namespace: str | None) -> list:
+        """Returns objects from the namespace. No API calls are made."""
+        with self._lock:
+            return list(self._store.get(namespace, {}).values())
+
+    def get(self, namespace: str | None, name: str):
+        """Returns the object or None if there is no such object. No API calls are made."""
+        with self._lock:
+            return self._store.get(namespace, {}).get(name)
+
+    def snapshot(self) -> dict[str | None, list]:
+        """Returns a consistent copy of the whole store as {namespace: objects}. No API calls are made."""
+        with self._lock:
+            return {namespace: list(objects.values()) for namespace, objects in self._store.items()}
+
+    def totals(self, namespace: str | None) -> tuple | None:
+        """Returns the sum of summaries of the objects in the namespace or None if it has no objects"""
+        with self._lock:
+            return self._totals.get(namespace)
+
+    def _summary(self, obj) -> tuple[str, tuple] | None:
+        """Returns (resourceVersion, summary) of the object reusing the summary computed for the same version"""
+        if self._summarize is None:
+            return None
+        cached = self._summaries.get((obj.metadata.namespace, obj.metadata.name))
+        if cached is not None and cached[0] == obj.metadata.resource_version:
+            return cached
+        return obj.metadata.resource_version, self._summarize(obj)
+
+    def _relist(self) -> None:
+        result = self._list_func(watch=False)
+        store: dict[str | None, dict[str, object]] = {}
+        summaries: dict[tuple[str | None, str], tuple[str, tuple]] = {}
+        totals: dict[str | None, tuple] = {}
+        for obj in result.items:
+            store.setdefault(obj.metadata.namespace, {})[obj.metadata.name] = obj
+            summary = self._summary(obj)
+            if summary is not None:
+                summaries[(obj.metadata.namespace, obj.metadata.name)] = summary
+                totals[obj.metadata.namespace] = _add(totals.get(obj.metadata.namespace), summary[1])
+        with self._lock:
+            self._store = store
+            self._summaries = summaries
+            self._totals = totals
+            self.generation += 1
+        self._resource_version = result.metadata.resource_version
+        self._synced.set()
+        logging.debug(f"{self.kind} informer listed {len(result.items)} objects")
+
+    def _apply_event(self, event_type: str, obj) -> None:
+        namespace, name = obj.metadata.namespace, obj.metadata.name
+        # Summaries are computed outside the lock. They are written by this (watching) thread only
+        summary = self._summary(obj) if event_type != "DELETED" else None
+        with self._lock:
+            objects = self._store.setdefault(namespace, {})
+            if event_type == "DELETED":
+                if objects.pop(name, None) is not None:
+                    self.generation += 1
+            else:
+                if name not in objects:
+                    self.generation += 1
+                objects[name] = obj
+            if not objects:
+                del self._store[namespace]
+
+            if self._summarize is not None:
+                old_summary = self._summaries.pop((namespace, name), None)
+                total = self._totals.get(namespace)
+                if old_summary is not None:
+                    total = _subtract(total, old_summary[1])
+                if summary is not None:
+                    self._summaries[(namespace, name)] = summary
+                    total = _add(total, summary[1])
+                if namespace in self._store:
+                    self._totals[namespace] = total
+                else:
+                    self._totals.pop(namespace, None)
+
+    def _watch_once(self) -> None:
+        self._watch = kubernetes.watch.Watch()
+        for event in self._watch.stream(
+            self._list_func,
+            resource_version=self._resource_version,
+            timeout_seconds=self._watch_timeout,
+            allow_watch_bookmarks=True,
+        ):
+            if event["type"] != "BOOKMARK":
+                self._apply_event(event["type"], event["object"])
+            if self._watch.resource_version is not None:
+                self._resource_version = self._watch.resource_version
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                if self._resource_version is None:
+                    self._relist()
+                self._watch_once()
+            except ApiException as e:
+                if e.status == HTTP_STATUS_GONE:
+                    logging.info(f"{self.kind} informer resourceVersion expired, re-listing")
+                    self._resource_version = None
+                else:
+                    logging.error(f"{self.kind} informer failed: {str(e)}")
+                    self._stopped.wait(self._retry_period)
+            except Exception as e:
+                logging.error(f"{self.kind} informer failed: {str(e)}")
+                self._resource_version = None
+                self._stopped.wait(self._retry_period)
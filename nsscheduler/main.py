@@ -5,13 +5,28 @@ import logging
 import sys
 import threading
 import time
+from datetime import timedelta
 
 import uvicorn
 import yaml
 
+from nsscheduler.capacity import CapacityGate
 from nsscheduler.data_models.scheduler_config import Config
-from nsscheduler.scheduler import schedule_env
-from nsscheduler.updown import kube_init
+from nsscheduler.rate_limit import AdmissionQueue, configure_api_rate_limit
+from nsscheduler.scheduler import (
+    register_env,
+    run_scheduler,
+    set_admission_queue,
+    set_capacity_gate,
+    set_state_store,
+)
+from nsscheduler.state_store import StateStore
+from nsscheduler.updown import (
+    configure_kube_executor,
+    configure_ns_state_cache,
+    kube_init,
+    start_informers,
+)
 
 
 def read_config(config_file: str) -> Config:
@@ -21,11 +36,11 @@ def read_config(config_file: str) -> Config:
 
 async def _run_scheduling(config: Config):
     logging.debug("Starting scheduling coroutine")
-    async with asyncio.TaskGroup() as tg:
-        # Run scheduling tasks asynchronously
-        for env_name, env in config.envs.items():
-            logging.debug(f"Scheduling environment {env_name}")
-            tg.create_task(schedule_env(env, env_name, config.schedules[env.schedule]))
+    for env_name, env in config.envs.items():
+        logging.debug(f"Scheduling environment {env_name}")
+        register_env(env, env_name, config.schedules[env.schedule])
+    # A single task executes actions of all environments
+    await run_scheduler()
 
 
 async def _run():
@@ -47,6 +62,51 @@ async def _run():
     )
     parser.add_argument("--incluster", help="we run inside kubernetes cluster", default=False, action="store_true")
     parser.add_argument("--context", help="kubernetes config context to use")
+    parser.add_argument(
+        "--state-file",
+        help="path to the SQLite file to persist the scheduler state to (state is not persisted if omitted)",
+    )
+    parser.add_argument(
+        "--catch-up-window",
+        default=86400,
+        type=int,
+        help="on startup, execute an action missed during downtime if it was due within this number of seconds",
+    )
+    parser.add_argument(
+        "--kube-workers", default=16, type=int, help="number of threads used to make kubernetes API calls"
+    )
+    parser.add_argument(
+        "--kube-qps", default=20, type=float, help="maximum rate of kubernetes API calls per second, 0 means no limit"
+    )
+    parser.add_argument("--kube-burst", default=40, type=int, help="maximum burst of kubernetes API calls")
+    parser.add_argument(
+        "--max-concurrent-actions",
+        default=0,
+        type=int,
+        help="maximum number of environment actions executed at once, 0 means no limit",
+    )
+    parser.add_argument(
+        "--action-jitter",
+        default=0,
+        type=float,
+        help="delay scheduled actions by a random number of seconds up to this value to spread the API server load",
+    )
+    parser.add_argument(
+        "--capacity-wait",
+        default=0,
+        type=float,
+        help="wait up to this number of seconds for the cluster to have enough free resources before starting an"
+        " environment, 0 disables the check",
+    )
+    parser.add_argument(
+        "--state-cache-ttl",
+        default=3,
+        type=float,
+        help="number of seconds namespace states listed from the API server are cached for",
+    )
+    parser.add_argument(
+        "--state-cache-size", default=1024, type=int, help="maximum number of namespace states in the cache"
+    )
 
     args = parser.parse_args()
 
@@ -61,8 +121,23 @@ async def _run():
     # Initialize kubernetes client
     logging.debug("Initializing kubernetes client")
     kube_init(args)
+    configure_kube_executor(args.kube_workers)
+    configure_api_rate_limit(args.kube_qps, args.kube_burst)
+    configure_ns_state_cache(args.state_cache_ttl, args.state_cache_size)
     logging.debug("Kubernetes client initialized")
 
+    # Start watching workloads
+    logging.debug("Starting workload informers")
+    start_informers()
+
+    # Restore scheduler state
+    if args.state_file is not None:
+        logging.debug(f"Using state file {args.state_file}")
+        set_state_store(StateStore(args.state_file), timedelta(seconds=args.catch_up_window))
+
+    set_admission_queue(AdmissionQueue(args.max_concurrent_actions, args.action_jitter))
+    set_capacity_gate(CapacityGate(args.capacity_wait))
+
     # Run API server
     if args.no_api:
         await _run_scheduling(config)
@@ -0,0 +1,66 @@
+import re
+import threading
+from dataclasses import dataclass
+
+from nsscheduler.informer import Informer
+
+
+@dataclass
+class CompiledPatterns:
+    """Namespace patterns of one environment compiled once"""
+
+    # Matches a namespace if any of the patterns does. Used to cheaply filter out namespaces matched by none of them
+    combined: re.Pattern
+    patterns: list[re.Pattern]
+
+    def resolve(self, all_namespaces: list[str]) -> list[str]:
+        candidates = [n for n in all_namespaces if self.combined.match(n)]
+        resolved_namespaces = []
+        for compiled_pattern in self.patterns:
+            resolved_namespaces.extend(n for n in candidates if compiled_pattern.match(n))
+        return resolved_namespaces
+
+
+class NamespaceResolver:
+    """
+    Resolves lists of namespace patterns to namespace names using a watched list of namespaces.
+
+    Patterns are compiled once per list and the results are memoized until a namespace is added or deleted.
+    """
+
+    def __init__(self, informer: Informer) -> None:
+        self._informer = informer
+        self._compiled: dict[tuple[str, ...], CompiledPatterns] = {}
+        self._resolved: dict[tuple[str, ...], tuple[int, list[str]]] = {}
+        self._lock = threading.Lock()
+
+    def has_synced(self) -> bool:
+        return self._informer.has_synced()
+
+    def namespaces(self) -> list[str]:
+        """Returns names of all existing namespaces. No API calls are made."""
+        return sorted(ns.metadata.name for ns in self._informer.list(None))
+
+    def compile(self, patterns: list[str]) -> CompiledPatterns:
+        key = tuple(patterns)
+        with self._lock:
+            if key not in self._compiled:
+                # Every pattern is wrapped in its own group so that the combined pattern matches exactly the namespaces
+                # that the patterns match separately
+                self._compiled[key] = CompiledPatterns(
+                    combined=re.compile("|".join(f"(?:^{pattern}$)" for pattern in patterns)),
+                    patterns=[re.compile(f"^{pattern}$") for pattern in patterns],
+                )
+            return self._compiled[key]
+
+    def resolve(self, patterns: list[str]) -> list[str]:
+        key = tuple(patterns)
+        generation = self._informer.generation
+        with self._lock:
+            if key in self._resolved and self._resolved[key][0] == generation:
+                return list(self._resolved[key][1])
+
+        resolved_namespaces = self.compile(patterns).resolve(self.namespaces())
+        with self._lock:
+            self._resolved[key] = (generation, resolved_namespaces)
+        return list(resolved_namespaces)
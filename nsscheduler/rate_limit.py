@@ -0,0 +1,132 @@
+import asyncio
+import contextlib
+import heapq
+import logging
+import random
+import threading
+import time
+from itertools import count
+
+from kubernetes.client.exceptions import ApiException
+
+# Kubernetes API errors, after which the request is retried: 409 Conflict and 429 Too Many Requests
+retriable_statuses = (409, 429)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Allows `qps` calls per second on average with bursts of up to `burst` calls.
+    Non-positive `qps` disables the limit.
+    """
+
+    def __init__(self, qps: float = 0, burst: int = 1) -> None:
+        self.qps = qps
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until the call is allowed"""
+        if self.qps <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.qps)
+            self._updated_at = now
+            # The token is reserved right away, so that callers are served in the order of arrival
+            self._tokens -= 1
+            delay = -self._tokens / self.qps if self._tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+api_rate_limiter = TokenBucket()
+api_retries = 5
+api_retry_backoff = 0.5
+
+
+def configure_api_rate_limit(qps: float, burst: int, retries: int = 5, backoff: float = 0.5) -> None:
+    """Sets the process-wide budget of kubernetes API calls made through call_api"""
+    global api_rate_limiter, api_retries, api_retry_backoff
+    api_rate_limiter = TokenBucket(qps, burst)
+    api_retries = retries
+    api_retry_backoff = backoff
+
+
+def _retry_delay(e: ApiException, attempt: int) -> float:
+    retry_after = e.headers.get("Retry-After") if e.headers else None
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # Exponential backoff with full jitter, so that throttled callers do not retry in lockstep
+    return random.uniform(0, api_retry_backoff * 2**attempt)
+
+
+def call_api(func, *args, **kwargs):
+    """
+    Calls a (blocking) kubernetes client function within the process-wide rate limit. Requests rejected with 409 or 429
+    are retried with exponential backoff (or after Retry-After if the server sent it) at most `api_retries` times.
+    """
+    for attempt in range(api_retries + 1):
+        api_rate_limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except ApiException as e:
+            if e.status not in retriable_statuses or attempt == api_retries:
+                raise
+            delay = _retry_delay(e, attempt)
+            logging.warning(f"Kubernetes API responded with {e.status} {e.reason}, retrying in {delay:.2f} seconds")
+            time.sleep(delay)
+
+
+class AdmissionQueue:
+    """
+    Limits the number of environment actions executed at once. Waiting actions are admitted in the order of priority
+    (lower first) and then of arrival. Actions may also be delayed by a random jitter, so that environments sharing a
+    schedule do not hit the API server at the very same moment.
+    """
+
+    def __init__(self, max_concurrent: int = 0, jitter: float = 0) -> None:
+        """
+        :param max_concurrent: maximum number of actions executed at once, 0 means no limit
+        :param jitter: maximum random delay in seconds before the action is queued for admission
+        """
+        self.max_concurrent = max_concurrent
+        self.jitter = jitter
+        self._running = 0
+        self._waiting: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = count()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, priority: int, jitter: bool = True):
+        if jitter and self.jitter > 0:
+            await asyncio.sleep(random.uniform(0, self.jitter))
+        if self.max_concurrent > 0:
+            if self._running < self.max_concurrent and not self._waiting:
+                self._running += 1
+            else:
+                future = asyncio.get_running_loop().create_future()
+                heapq.heappush(self._waiting, (priority, next(self._seq), future))
+                try:
+                    # The slot is handed over by _release when the future is resolved
+                    await future
+                except asyncio.CancelledError:
+                    if future.done() and not future.cancelled():
+                        self._release()
+                    raise
+        try:
+            yield
+        finally:
+            if self.max_concurrent > 0:
+                self._release()
+
+    def _release(self) -> None:
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._running -= 1
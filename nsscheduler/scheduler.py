@@ -1,15 +1,21 @@
 import asyncio
+import functools
+import heapq
 import logging
+import re
+import time
 import warnings
 from collections import deque
-from dataclasses import dataclass
-from datetime import datetime, time, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from decimal import Decimal
 from enum import Enum
-from itertools import chain
-from threading import Lock
+from itertools import count
 
-from pytz import timezone
+from pytz import timezone, utc
 
+from nsscheduler.capacity import CapacityGate
 from nsscheduler.data_models.api import (
     EnvironmentState,
     EnvStateResponse,
@@ -17,8 +23,25 @@ from nsscheduler.data_models.api import (
     StateAllResponse,
 )
 from nsscheduler.data_models.internal import Action, ActionDateType, ActionType
-from nsscheduler.data_models.scheduler_config import Environment, Schedule
-from nsscheduler.updown import down, get_state, up
+from nsscheduler.data_models.scheduler_config import BatchMode, Environment, Schedule
+from nsscheduler.rate_limit import AdmissionQueue
+from nsscheduler.singleflight import SingleFlight
+from nsscheduler.state_store import StateStore, StoredEnvState, schedule_fingerprint
+from nsscheduler.timeline import actions_cache
+from nsscheduler.updown import (
+    ActionJournal,
+    ClusterSnapshot,
+    PlannedWorkload,
+    down,
+    get_scale_up_requests,
+    get_state,
+    informers_synced,
+    run_blocking,
+    scale_up_requests,
+    take_snapshot,
+    up,
+    wait_until_ready,
+)
 
 
 def get_actions_in_interval(schedule: Schedule, starting_from: datetime, until: datetime) -> list[Action]:
@@ -28,66 +51,7 @@ def get_actions_in_interval(schedule: Schedule, starting_from: datetime, until:
     Both starting_from and until must be timezone-aware timestamps.
     """
     assert starting_from.tzinfo is not None and until.tzinfo is not None
-
-    def lies_within_range(_datetime: datetime) -> bool:
-        return starting_from <= _datetime <= until
-
-    actions = []
-
-    for holiday in schedule.holidays:
-        if lies_within_range(holiday.stop):
-            actions.append(
-                Action(
-                    action_type=ActionType.STOP,
-                    action_date_type=ActionDateType.HOLIDAY,
-                    datetime=holiday.stop.replace(tzinfo=timezone(schedule.timezone_str)),
-                )
-            )
-        if lies_within_range(holiday.start):
-            actions.append(
-                Action(
-                    action_type=ActionType.START,
-                    action_date_type=ActionDateType.HOLIDAY,
-                    datetime=holiday.start.replace(tzinfo=timezone(schedule.timezone_str)),
-                )
-            )
-
-    def is_datetime_on_holidays(_datetime: datetime):
-        # I am pretty sure that this can be done in log(n), but that would make code a bit more complex
-        for holiday in schedule.holidays:
-            if holiday.stop <= _datetime <= holiday.start:
-                return True
-        return False
-
-    for weekday_entry in schedule.weekdays:
-        for weekday in weekday_entry.days:
-            stop_actions = (
-                [(ActionType.STOP, time) for time in weekday_entry.stop] if weekday_entry.stop is not None else []
-            )
-            start_actions = (
-                [(ActionType.START, time) for time in weekday_entry.start] if weekday_entry.start is not None else []
-            )
-            for action_type, action_time in chain(stop_actions, start_actions):
-                # we use Monday = 1, Sunday = 7 (while datetime.weekday() returns Monday = 0, Sunday = 6)
-                action_date = starting_from.date() - timedelta(days=(starting_from.weekday() + 1 - weekday) % 7)
-                while (
-                    datetime.combine(
-                        action_date, time(hour=0, minute=0, second=0, tzinfo=timezone(schedule.timezone_str))
-                    )
-                    <= until
-                ):
-                    candidate_datetime = datetime.combine(action_date, action_time)
-                    if lies_within_range(candidate_datetime) and not is_datetime_on_holidays(candidate_datetime):
-                        actions.append(
-                            Action(
-                                action_type=action_type,
-                                action_date_type=ActionDateType.WEEKDAY,
-                                datetime=candidate_datetime,
-                            )
-                        )
-                    action_date += timedelta(days=7)
-
-    return sorted(actions)
+    return list(actions_cache.get(schedule, starting_from, until))
 
 
 class EnvControllerState(Enum):
@@ -118,14 +82,99 @@ class WrongEnvNameException(EnvironmentSchedulerException):
 
 @dataclass
 class EnvironmentController:
+    env_name: str
     action_queue: deque[Action]
     env_state: EnvControllerState
-    env_state_lock: Lock
+    env_state_lock: asyncio.Lock
     schedule: Schedule
     env: Environment
+    queue_recalculation_period: timedelta = timedelta(days=30)
+    next_queue_recalculation_date: datetime | None = None
+    # Deadline of the timer armed for the head of action_queue
+    armed_at: datetime | None = None
+    # Task executing (or about to execute) an action of the environment. There is at most one at a time.
+    executor: asyncio.Task | None = None
+    # Rolling estimate of the time in seconds the env takes to become ready after START (see Environment.ready_by)
+    ready_estimate: float | None = None
+    # Task measuring the time the environment takes to become ready after the last START
+    ready_tracker: asyncio.Task | None = None
+
+    def is_executing(self) -> bool:
+        return self.executor is not None and not self.executor.done()
 
 
 _env_controllers: dict[str, EnvironmentController] = {}
+_state_store: StateStore | None = None
+# State store writes are made in this thread to keep the event loop responsive. A single thread keeps them in order
+_state_store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+_catch_up_window = timedelta(days=1)
+# Coalesces concurrent state requests
+_state_requests = SingleFlight()
+# Weight of the latest measurement in the rolling estimate of the time environments take to become ready
+ready_estimate_smoothing = 0.3
+# Measurement is discarded if the environment is not ready after this number of seconds
+ready_tracking_timeout = 3600
+# Actions of all environments are admitted through this queue. By default it neither limits nor delays them
+_admission_queue = AdmissionQueue()
+# Scale-ups wait for free cluster resources at this gate. Disabled by default
+_capacity_gate = CapacityGate(max_wait=0)
+
+
+def set_state_store(state_store: StateStore | None, catch_up_window: timedelta = timedelta(days=1)):
+    """
+    Enables persisting of the scheduler state. Must be called before environments are registered.
+
+    :param state_store: store to warm up from and to persist the state to
+    :param catch_up_window: on startup, an action missed (or interrupted) during downtime is executed only if it was
+        due no earlier than this period ago
+    """
+    global _state_store, _catch_up_window
+    _state_store = state_store
+    _catch_up_window = catch_up_window
+
+
+def set_admission_queue(admission_queue: AdmissionQueue):
+    """
+    Limits the number of environment actions executed at once. Manual actions are admitted first, then holiday and
+    then weekday ones; jitter is applied to the scheduled actions only.
+    """
+    global _admission_queue
+    _admission_queue = admission_queue
+
+
+def set_capacity_gate(capacity_gate: CapacityGate):
+    """Makes START actions wait until the cluster has enough free resources for the pods they are going to start"""
+    global _capacity_gate
+    _capacity_gate = capacity_gate
+
+
+async def _run_in_state_store(func, *args):
+    """Calls the StateStore method in the state store thread and returns its result"""
+    return await asyncio.get_running_loop().run_in_executor(_state_store_executor, functools.partial(func, *args))
+
+
+def _submit_to_state_store(func, *args) -> Future:
+    """Queues the StateStore write to the state store thread without waiting for it. Failures are logged."""
+
+    def log_failure(future: Future):
+        if future.exception() is not None:
+            logging.error(f"Failed to persist the scheduler state: {str(future.exception())}")
+
+    future = _state_store_executor.submit(func, *args)
+    future.add_done_callback(log_failure)
+    return future
+
+
+def _persist_queue(env_controller: EnvironmentController):
+    if _state_store is not None:
+        _submit_to_state_store(
+            _state_store.save_queue,
+            env_controller.env_name,
+            env_controller.schedule,
+            # The queue is copied, because it keeps changing while the write is pending
+            list(env_controller.action_queue),
+            env_controller.next_queue_recalculation_date,
+        )
 
 
 def _get_env_controller(env_name: str) -> EnvironmentController:
@@ -135,10 +184,24 @@ def _get_env_controller(env_name: str) -> EnvironmentController:
         raise WrongEnvNameException from e
 
 
-def add_manual_action_to_queue(env_name: str, action_type: ActionType):
+async def add_manual_action_to_queue(env_name: str, action_type: ActionType, wait_started: bool = True) -> Action:
+    """
+    Puts manual action to the head of the environment's queue and starts executing it right away.
+
+    Returns once the execution has actually started or, if `wait_started` is False, as soon as the action is queued
+    (failures of such an action are only logged). Can be called from any event loop: if the scheduler runs in another
+    one, the call is forwarded to it.
+    """
+    if _scheduler_loop is not None and _scheduler_loop is not asyncio.get_running_loop():
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(
+                add_manual_action_to_queue(env_name, action_type, wait_started), _scheduler_loop
+            )
+        )
+
     env_controller = _get_env_controller(env_name)
-    with env_controller.env_state_lock:
-        if env_controller.env_state == EnvControllerState.ACTION_IN_PROGRESS:
+    async with env_controller.env_state_lock:
+        if env_controller.env_state == EnvControllerState.ACTION_IN_PROGRESS or env_controller.is_executing():
             raise AnotherActionIsInProgressException
         if env_controller.env_state == EnvControllerState.MANUAL_ACTION_SCHEDULED:
             raise ManualActionIsAlreadyScheduled
@@ -151,10 +214,24 @@ def add_manual_action_to_queue(env_name: str, action_type: ActionType):
         logging.debug(f"Added action {action} to action queue for env {env_name}")
         env_controller.env_state = EnvControllerState.MANUAL_ACTION_SCHEDULED
 
+    if not wait_started:
+        _start_executor(env_name)
+        return action
+    started = asyncio.get_running_loop().create_future()
+    _start_executor(env_name, started)
+    return await started
 
-async def get_env_state(env_name: str) -> EnvStateResponse:
+
+async def get_env_state(env_name: str, snapshot: ClusterSnapshot | None = None) -> EnvStateResponse:
+    if snapshot is None:
+        # Concurrent requests for the environment (e.g. from several dashboards) share a single computation
+        return await _state_requests.do(("env", env_name), _get_env_state, env_name)
+    return await _get_env_state(env_name, snapshot)
+
+
+async def _get_env_state(env_name: str, snapshot: ClusterSnapshot | None = None) -> EnvStateResponse:
     env_controller = _get_env_controller(env_name)
-    ns_states = await get_state(env_controller.env.namespaces)
+    ns_states = await get_state(env_controller.env.namespaces, snapshot)
 
     # TODO: should this be behind env_state_lock?
     if env_controller.env_state == EnvControllerState.ACTION_IN_PROGRESS:
@@ -167,59 +244,241 @@ async def get_env_state(env_name: str) -> EnvStateResponse:
     return EnvStateResponse(
         env_name=env_name,
         env_state=env_state,
-        env_schedule=env_controller.schedule,
+        schedule_name=env_controller.env.schedule,
         next_action=env_controller.action_queue[0] if env_controller.action_queue else None,
         namespaces=[NamespaceStateResponse(namespace_name=name, state=state) for name, state in ns_states.items()],
     )
 
 
+def get_schedules() -> dict[str, Schedule]:
+    """Returns schedules of the registered environments by name"""
+    return {env_controller.env.schedule: env_controller.schedule for env_controller in _env_controllers.values()}
+
+
+def list_env_names(
+    name_prefix: str | None = None, name_regex: str | None = None, schedule_name: str | None = None
+) -> list[str]:
+    """Returns sorted names of the environments matching all the given filters"""
+    compiled_regex = re.compile(name_regex) if name_regex is not None else None
+    return sorted(
+        env_name
+        for env_name, env_controller in _env_controllers.items()
+        if (name_prefix is None or env_name.startswith(name_prefix))
+        and (compiled_regex is None or compiled_regex.search(env_name))
+        and (schedule_name is None or env_controller.env.schedule == schedule_name)
+    )
+
+
+async def get_env_states(env_names: list[str]) -> list[EnvStateResponse]:
+    """Returns states of the environments. States of the other environments are not computed."""
+    return await _state_requests.do(("envs", tuple(env_names)), _get_env_states, env_names)
+
+
+async def _get_env_states(env_names: list[str]) -> list[EnvStateResponse]:
+    # Synced informers keep per-namespace totals, so no snapshot is needed. Otherwise one snapshot of the cluster is
+    # shared by all environments, so the API server is queried a constant number of times regardless of their number
+    snapshot = None if informers_synced() else await run_blocking(take_snapshot)
+    return [await get_env_state(env_name, snapshot) for env_name in env_names]
+
+
 async def get_all_env_states() -> StateAllResponse:
-    tasks = [asyncio.create_task(get_env_state(env_name)) for env_name in _env_controllers.keys()]
-    return StateAllResponse(environments=[await task for task in tasks])
+    return StateAllResponse(environments=await get_env_states(list(_env_controllers)))
 
 
-async def run_action(env_controller: EnvironmentController):
-    """Executes next action in the env_controller.action_queue"""
-    with env_controller.env_state_lock:
+async def run_action(env_controller: EnvironmentController, started: asyncio.Future | None = None):
+    """
+    Executes next action in the env_controller.action_queue
+
+    :param started: if provided, its result is set to the action once the execution has started
+    """
+    async with env_controller.env_state_lock:
         if env_controller.env_state == EnvControllerState.ACTION_IN_PROGRESS:
             raise AnotherActionIsInProgressException
         env_controller.env_state = EnvControllerState.ACTION_IN_PROGRESS
+        action = env_controller.action_queue.popleft()
+        remaining_queue = list(env_controller.action_queue)
+    if _state_store is not None:
+        try:
+            await _run_in_state_store(_state_store.action_started, env_controller.env_name, action, remaining_queue)
+        except Exception:
+            # The action has not started, so the environment must not be left in ACTION_IN_PROGRESS. Scheduled actions
+            # are put back to be retried, the caller of a manual one gets the error instead
+            async with env_controller.env_state_lock:
+                if action.action_date_type != ActionDateType.MANUAL:
+                    env_controller.action_queue.appendleft(action)
+                env_controller.env_state = EnvControllerState.IDLE
+            raise
+
+    started_at = time.monotonic()
+    if env_controller.ready_tracker is not None:
+        env_controller.ready_tracker.cancel()
+        env_controller.ready_tracker = None
 
-    action = env_controller.action_queue.popleft()
     env = env_controller.env
+    needed_cpu = needed_memory = Decimal(0)
+    if action.action_type == ActionType.START and _capacity_gate.max_wait > 0:
+        needed_cpu, needed_memory = await get_scale_up_requests(env.namespaces)
+
+    # Resources are waited for before the admission slot is taken, so that STOP actions (the only ones freeing
+    # resources) are not kept out of the admission queue by START actions waiting for them
+    async with _capacity_gate.admit(env_controller.env_name, needed_cpu, needed_memory) as reservation:
+        async with _admission_queue.admit(
+            action.action_date_type.value, jitter=action.action_date_type != ActionDateType.MANUAL
+        ):
+            # The caller is released only once the action is admitted, not while it is queued. A caller, which has
+            # gone away in the meantime (e.g. a timed out request), has cancelled `started`, but the action still runs
+            if started is not None and not started.done():
+                started.set_result(action)
+
+            journal = None
+            if _state_store is not None:
+                env_name = env_controller.env_name
+                journal = ActionJournal(
+                    completed=await _run_in_state_store(_state_store.completed_workloads, env_name),
+                    on_completed=lambda workload: _submit_to_state_store(
+                        _state_store.workload_completed, env_name, workload
+                    ),
+                )
+                if journal.completed:
+                    logging.info(
+                        f"Resuming action {action} for env {env_name}, {len(journal.completed)} workloads are done"
+                    )
 
-    if action.action_type == ActionType.STOP:
-        await down(env.namespaces)
-    elif action.action_type == ActionType.START:
-        if env.batch is not None:
-            await up(env.namespaces, env.batch.size, env.batch.timeout)
-        else:
-            await up(env.namespaces)
-    else:
-        assert False, "Not Reachable"
+            if action.action_type == ActionType.STOP:
+                await down(env.namespaces, journal=journal, concurrency=env.concurrency)
+            elif action.action_type == ActionType.START:
+                scaled: list[PlannedWorkload] = []
+
+                def on_patched(planned: PlannedWorkload):
+                    scaled.append(planned)
+                    if reservation.cpu > 0 or reservation.memory > 0:
+                        # Pods of the scaled up workload are counted by the capacity gate once created, so their
+                        # resources are not kept reserved
+                        reservation.release(*scale_up_requests(planned.workload))
+
+                if env.batch is not None:
+                    await up(
+                        env.namespaces,
+                        env.batch.size,
+                        env.batch.timeout,
+                        journal=journal,
+                        concurrency=env.concurrency,
+                        batch_until_ready=env.batch.mode == BatchMode.READINESS,
+                        batch_cpu=env.batch.cpu,
+                        batch_memory=env.batch.memory,
+                        on_patched=on_patched,
+                    )
+                else:
+                    await up(env.namespaces, journal=journal, concurrency=env.concurrency, on_patched=on_patched)
+                # Only the time of a scheduled START, which has scaled the environment up from scratch, is a
+                # measurement of how long it takes to become ready. Manual, resumed and no-op STARTs are not
+                if (
+                    env.ready_by
+                    and action.action_date_type != ActionDateType.MANUAL
+                    and scaled
+                    and (journal is None or not journal.completed)
+                ):
+                    env_controller.ready_tracker = asyncio.create_task(
+                        _track_ready_duration(env_controller, started_at, scaled)
+                    )
+            else:
+                assert False, "Not Reachable"
 
-    with env_controller.env_state_lock:
+    if _state_store is not None:
+        await _run_in_state_store(_state_store.action_finished, env_controller.env_name, action)
+    async with env_controller.env_state_lock:
         env_controller.env_state = EnvControllerState.IDLE
 
 
-async def schedule_env(
+async def _track_ready_duration(
+    env_controller: EnvironmentController, started_at: float, scaled: list[PlannedWorkload]
+):
+    if not await wait_until_ready(scaled, ready_tracking_timeout):
+        return
+    duration = time.monotonic() - started_at
+    if env_controller.ready_estimate is None:
+        env_controller.ready_estimate = duration
+    else:
+        env_controller.ready_estimate += ready_estimate_smoothing * (duration - env_controller.ready_estimate)
+    logging.info(
+        f"Env {env_controller.env_name} became ready in {duration:.0f} seconds, "
+        f"estimate is {env_controller.ready_estimate:.0f} seconds"
+    )
+    if _state_store is not None:
+        _submit_to_state_store(_state_store.save_ready_estimate, env_controller.env_name, env_controller.ready_estimate)
+    # The lead of the next START has changed
+    _arm(env_controller.env_name)
+
+
+class TimerType(Enum):
+    ACTION: int = 0
+    QUEUE_RECALCULATION: int = 1
+
+
+@dataclass(order=True)
+class Timer:
+    deadline: datetime
+    seq: int
+    env_name: str = field(compare=False)
+    timer_type: TimerType = field(compare=False)
+
+
+# All environments share one heap of timers which is served by a single scheduler task (see run_scheduler).
+# Timers are never removed from the heap: an action timer, which is not equal to env_controller.armed_at by the time
+# it fires, is stale and is just skipped.
+_timers: list[Timer] = []
+_timer_seq = count()
+_timers_changed: asyncio.Event | None = None
+_scheduler_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _push_timer(deadline: datetime, env_name: str, timer_type: TimerType):
+    timer = Timer(deadline, next(_timer_seq), env_name, timer_type)
+    heapq.heappush(_timers, timer)
+    if _timers[0] is timer and _timers_changed is not None:
+        # The new timer is the earliest one, so the scheduler has to re-arm its sleep
+        _timers_changed.set()
+
+
+def _arm(env_name: str):
+    """Makes sure that there is a timer for the head of the environment's action_queue"""
+    env_controller = _env_controllers[env_name]
+    if not env_controller.action_queue:
+        env_controller.armed_at = None
+        return
+    deadline = env_controller.action_queue[0].datetime - _prewarm_lead(env_controller, env_controller.action_queue[0])
+    if env_controller.armed_at != deadline:
+        env_controller.armed_at = deadline
+        _push_timer(deadline, env_name, TimerType.ACTION)
+
+
+def _prewarm_lead(env_controller: EnvironmentController, action: Action) -> timedelta:
+    """Returns how much earlier than scheduled the action is executed, so that the environment is ready on time"""
+    env = env_controller.env
+    if (
+        not env.ready_by
+        or env_controller.ready_estimate is None
+        or action.action_type != ActionType.START
+        or action.action_date_type == ActionDateType.MANUAL
+    ):
+        return timedelta(0)
+    return timedelta(seconds=min(env_controller.ready_estimate, env.ready_by_max_lead))
+
+
+def register_env(
     env: Environment,
     env_name: str,
     schedule: Schedule,
     queue_recalculation_period: timedelta = timedelta(days=30),
-    _tick_period: float = 3,
-):
+) -> EnvironmentController:
     """
-    Manage environment according to a schedule.
+    Start managing environment according to a schedule. Actions are executed by run_scheduler.
 
     :param env: environment to manage
     :param env_name: name of the environment
     :param schedule: schedule to use
-    :param queue_recalculation_period:
-    :param _tick_period: sleep this number of seconds
+    :param queue_recalculation_period: actions are added to the queue by chunks covering this period
     """
-    global _env_controllers
-
     assert queue_recalculation_period > timedelta(seconds=0), "queue_recalculation_period must be positive"
     if queue_recalculation_period < timedelta(days=1):
         warnings.warn(
@@ -232,38 +491,169 @@ async def schedule_env(
 
     # Initial queue population
     logging.debug(f"Initialising action_queue for env={env_name}")
-    _env_controllers[env_name] = EnvironmentController(
-        action_queue=deque(), env_state=EnvControllerState.IDLE, env_state_lock=Lock(), schedule=schedule, env=env
+    env_controller = EnvironmentController(
+        env_name=env_name,
+        action_queue=deque(),
+        env_state=EnvControllerState.IDLE,
+        env_state_lock=asyncio.Lock(),
+        schedule=schedule,
+        env=env,
+        queue_recalculation_period=queue_recalculation_period,
     )
-    env_controller = _env_controllers[env_name]
-    next_queue_recalculation_date = datetime.now(tz=timezone(schedule.timezone_str))
-    for action in get_actions_in_interval(
-        schedule, next_queue_recalculation_date, next_queue_recalculation_date + 2 * queue_recalculation_period
+    _env_controllers[env_name] = env_controller
+    if _state_store is not None:
+        env_controller.ready_estimate = _state_store.load_ready_estimate(env_name)
+    now = datetime.now(tz=timezone(schedule.timezone_str))
+    stored = _state_store.load(env_name) if _state_store is not None else None
+    if (
+        stored is not None
+        and stored.schedule_fingerprint == schedule_fingerprint(schedule)
+        and stored.next_queue_recalculation_date is not None
+        and stored.next_queue_recalculation_date > now
     ):
-        env_controller.action_queue.append(action)
-    next_queue_recalculation_date += queue_recalculation_period
+        # Warm start: the stored queue is still valid
+        logging.debug(f"Restoring action_queue for env={env_name} from the state store")
+        env_controller.action_queue.extend(action for action in stored.action_queue if action.datetime >= now)
+        env_controller.next_queue_recalculation_date = stored.next_queue_recalculation_date
+    else:
+        # Windows are aligned to a minute, so that environments registered together share cached windows of their
+        # schedule
+        window_start = now.replace(second=0, microsecond=0)
+        env_controller.action_queue.extend(
+            action
+            for action in get_actions_in_interval(schedule, window_start, window_start + 2 * queue_recalculation_period)
+            if action.datetime >= now
+        )
+        env_controller.next_queue_recalculation_date = window_start + queue_recalculation_period
+
+    if stored is not None:
+        missed_action = _find_missed_action(stored, now)
+        if missed_action is not None:
+            logging.info(f"Catching up action {missed_action} missed by env {env_name}")
+            # It is due in the past, so it will be executed as soon as the scheduler starts
+            env_controller.action_queue.appendleft(missed_action)
+    _persist_queue(env_controller)
+
+    _push_timer(env_controller.next_queue_recalculation_date, env_name, TimerType.QUEUE_RECALCULATION)
+    _arm(env_name)
+    return env_controller
+
+
+def _find_missed_action(stored: StoredEnvState, now: datetime) -> Action | None:
+    """
+    Returns the latest action, which was due during downtime (or was interrupted by it) within the catch-up window.
+    Earlier missed actions are not needed, since the latest one defines the state the environment should be in.
+    """
+    candidates = [action for action in stored.action_queue if action.datetime < now]
+    if stored.action_in_progress is not None:
+        candidates.append(stored.action_in_progress)
+    candidates = [action for action in candidates if action.datetime >= now - _catch_up_window]
+    return max(candidates) if candidates else None
+
+
+def _recalculate_queue(env_name: str):
+    env_controller = _env_controllers[env_name]
+    recalculation_date = env_controller.next_queue_recalculation_date
+    period = env_controller.queue_recalculation_period
+    logging.debug(f"Repopulating action_queue for env={env_name}")
+    env_controller.action_queue.extend(
+        get_actions_in_interval(env_controller.schedule, recalculation_date + period, recalculation_date + 2 * period)
+    )
+    env_controller.next_queue_recalculation_date = recalculation_date + period
+    _persist_queue(env_controller)
+    _push_timer(env_controller.next_queue_recalculation_date, env_name, TimerType.QUEUE_RECALCULATION)
+    _arm(env_name)
+
+
+async def _execute_next_action(env_name: str, started: asyncio.Future | None = None):
+    env_controller = _env_controllers[env_name]
+    try:
+        await run_action(env_controller, started)
+    except AnotherActionIsInProgressException as e:
+        # Raised before the action was taken, the state belongs to the action in progress
+        if started is not None and not started.done():
+            started.set_exception(e)
+        else:
+            logging.error(f"Failed to execute action for env {env_name}: {str(e)}")
+    except Exception as e:
+        if started is not None and not started.done():
+            started.set_exception(e)
+        else:
+            logging.error(f"Failed to execute action for env {env_name}: {str(e)}")
+        async with env_controller.env_state_lock:
+            env_controller.env_state = EnvControllerState.IDLE
+    finally:
+        _arm(env_name)
+
+
+def _start_executor(env_name: str, started: asyncio.Future | None = None):
+    _env_controllers[env_name].executor = asyncio.create_task(_execute_next_action(env_name, started))
+
+
+def _fire(timer: Timer):
+    if timer.timer_type == TimerType.QUEUE_RECALCULATION:
+        _recalculate_queue(timer.env_name)
+        return
+
+    env_controller = _env_controllers[timer.env_name]
+    if env_controller.armed_at != timer.deadline:
+        return  # stale timer
+    env_controller.armed_at = None
+    if env_controller.is_executing():
+        return  # the environment will be re-armed once the action in progress completes
+
+    _start_executor(timer.env_name)
+
+
+async def run_scheduler(_max_sleep: float = 3600):
+    """
+    Executes actions of all registered environments in time.
+
+    Sleeps until the earliest deadline among all environments and wakes up earlier if a new timer with a closer deadline
+    is added (e.g. on manual action).
+
+    :param _max_sleep: the scheduler re-checks the clock at least once in this number of seconds
+    """
+    global _timers_changed, _scheduler_loop
+
+    _scheduler_loop = asyncio.get_running_loop()
+    _timers_changed = asyncio.Event()
 
-    # Main loop
     while True:
-        if datetime.now(tz=timezone(schedule.timezone_str)) >= next_queue_recalculation_date:
-            # Queue repopulation
-            logging.debug(f"Repopulating action_queue for env={env_name}")
-            for action in get_actions_in_interval(
-                schedule,
-                next_queue_recalculation_date + queue_recalculation_period,
-                next_queue_recalculation_date + 2 * queue_recalculation_period,
-            ):
-                env_controller.action_queue.append(action)
-            next_queue_recalculation_date += queue_recalculation_period
+        _timers_changed.clear()
+        now = datetime.now(tz=utc)
+        while _timers and _timers[0].deadline <= now:
+            _fire(heapq.heappop(_timers))
 
-        if not len(env_controller.action_queue) == 0:
-            next_action = env_controller.action_queue[0]
-            if next_action.datetime <= datetime.now(tz=timezone(schedule.timezone_str)):
-                await run_action(env_controller)
+        timeout = _max_sleep
+        if _timers:
+            timeout = min(timeout, (_timers[0].deadline - now).total_seconds())
+        try:
+            await asyncio.wait_for(_timers_changed.wait(), timeout=timeout)
+        except TimeoutError:
+            pass
 
-        await asyncio.sleep(_tick_period)
+
+async def schedule_env(
+    env: Environment,
+    env_name: str,
+    schedule: Schedule,
+    queue_recalculation_period: timedelta = timedelta(days=30),
+):
+    """
+    Manage a single environment according to a schedule. Use register_env + run_scheduler to manage many of them.
+    """
+    register_env(env, env_name, schedule, queue_recalculation_period)
+    await run_scheduler()
 
 
 def _reset_all_env_controllers():
-    global _env_controllers
+    global _env_controllers, _timers, _timers_changed, _scheduler_loop, _state_store, _admission_queue
+    global _capacity_gate
     _env_controllers = {}
+    _state_store = None
+    _admission_queue = AdmissionQueue()
+    _capacity_gate = CapacityGate(max_wait=0)
+    _timers = []
+    _timers_changed = None
+    _scheduler_loop = None
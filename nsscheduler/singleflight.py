@@ -0,0 +1,28 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while a call is in flight, other callers with the same key await its
+    result (or exception) instead of making their own call.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Future] = {}
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        # Futures can only be awaited from the loop they belong to, so calls are shared within one loop only
+        call_key = (asyncio.get_running_loop(), key)
+        future = self._calls.get(call_key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[call_key] = future
+            future.add_done_callback(lambda _: self._calls.pop(call_key, None))
+        # A caller going away (e.g. a disconnected HTTP client) must not cancel the call shared with the others
+        return await asyncio.shield(future)
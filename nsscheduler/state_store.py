@@ -0,0 +1,165 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+
+from nsscheduler.data_models.internal import Action
+from nsscheduler.data_models.scheduler_config import Schedule
+
+
+def schedule_fingerprint(schedule: Schedule) -> str:
+    """Returns a hash of the schedule, used to detect that a stored queue was computed for another schedule"""
+    return hashlib.sha256(schedule.json().encode()).hexdigest()
+
+
+@dataclass
+class StoredEnvState:
+    schedule_fingerprint: str | None
+    action_queue: list[Action]
+    next_queue_recalculation_date: datetime | None
+    action_in_progress: Action | None
+    last_action: Action | None
+
+
+class StateStore:
+    """
+    SQLite-backed store of the scheduler state, which allows to survive restarts.
+
+    For every environment it keeps the action queue, the action being executed (if any) with the workloads it has
+    already processed, the last completed action and the estimated time it takes to become ready.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS env_state (
+                    env_name TEXT PRIMARY KEY,
+                    schedule_fingerprint TEXT,
+                    action_queue TEXT NOT NULL DEFAULT '[]',
+                    next_queue_recalculation_date TEXT,
+                    action_in_progress TEXT,
+                    last_action TEXT
+                )
+                """
+            )
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS workload_progress (
+                    env_name TEXT NOT NULL,
+                    workload TEXT NOT NULL,
+                    PRIMARY KEY (env_name, workload)
+                )
+                """
+            )
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ready_estimate (
+                    env_name TEXT PRIMARY KEY,
+                    seconds REAL NOT NULL
+                )
+                """
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _upsert(self, env_name: str, **columns) -> None:
+        names = ", ".join(columns)
+        placeholders = ", ".join("?" for _ in columns)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in columns)
+        with self._lock:
+            self._connection.execute(
+                f"INSERT INTO env_state (env_name, {names}) VALUES (?, {placeholders}) "
+                f"ON CONFLICT (env_name) DO UPDATE SET {updates}",
+                (env_name, *columns.values()),
+            )
+
+    def save_queue(
+        self, env_name: str, schedule: Schedule, action_queue, next_queue_recalculation_date: datetime | None
+    ) -> None:
+        self._upsert(
+            env_name,
+            schedule_fingerprint=schedule_fingerprint(schedule),
+            action_queue=json.dumps([action.json() for action in action_queue]),
+            next_queue_recalculation_date=(
+                next_queue_recalculation_date.isoformat() if next_queue_recalculation_date is not None else None
+            ),
+        )
+
+    def action_started(self, env_name: str, action: Action, action_queue) -> None:
+        """
+        Marks the action as in progress. If the same action was already in progress (i.e. it was interrupted and is now
+        resumed), workload progress recorded for it is kept, otherwise it is reset.
+        """
+        stored = self.load(env_name)
+        if stored is None or stored.action_in_progress is None or stored.action_in_progress != action:
+            with self._lock:
+                self._connection.execute("DELETE FROM workload_progress WHERE env_name = ?", (env_name,))
+        self._upsert(
+            env_name,
+            action_in_progress=action.json(),
+            action_queue=json.dumps([queued_action.json() for queued_action in action_queue]),
+        )
+
+    def action_finished(self, env_name: str, action: Action) -> None:
+        self._upsert(env_name, action_in_progress=None, last_action=action.json())
+        with self._lock:
+            self._connection.execute("DELETE FROM workload_progress WHERE env_name = ?", (env_name,))
+
+    def workload_completed(self, env_name: str, workload: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO workload_progress (env_name, workload) VALUES (?, ?)", (env_name, workload)
+            )
+
+    def completed_workloads(self, env_name: str) -> set[str]:
+        """Returns workloads already processed by the action in progress"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT workload FROM workload_progress WHERE env_name = ?", (env_name,)
+            ).fetchall()
+        return {workload for (workload,) in rows}
+
+    def save_ready_estimate(self, env_name: str, seconds: float) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO ready_estimate (env_name, seconds) VALUES (?, ?) "
+                "ON CONFLICT (env_name) DO UPDATE SET seconds = excluded.seconds",
+                (env_name, seconds),
+            )
+
+    def load_ready_estimate(self, env_name: str) -> float | None:
+        """Returns the estimated time in seconds the environment takes to become ready after START"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT seconds FROM ready_estimate WHERE env_name = ?", (env_name,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def load(self, env_name: str) -> StoredEnvState | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT schedule_fingerprint, action_queue, next_queue_recalculation_date, action_in_progress, "
+                "last_action FROM env_state WHERE env_name = ?",
+                (env_name,),
+            ).fetchone()
+        if row is None:
+            return None
+        fingerprint, action_queue, next_queue_recalculation_date, action_in_progress, last_action = row
+        return StoredEnvState(
+            schedule_fingerprint=fingerprint,
+            action_queue=[Action.parse_raw(action) for action in json.loads(action_queue)],
+            next_queue_recalculation_date=(
+                datetime.fromisoformat(next_queue_recalculation_date) if next_queue_recalculation_date else None
+            ),
+            action_in_progress=Action.parse_raw(action_in_progress) if action_in_progress else None,
+            last_action=Action.parse_raw(last_action) if last_action else None,
+        )
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import time as time_of_day
+from typing import AsyncIterator, Awaitable, Callable
+
+import orjson
+from pydantic import BaseModel
+
+from nsscheduler.data_models.api import EnvStateResponse, StateAllResponse
+
+
+def _encode_default(value):
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, (datetime, time_of_day)):
+        # orjson would normalize the offsets of pytz timezones, while pydantic keeps them as they are
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json(obj) -> bytes:
+    """Encodes pydantic models (or dicts and lists of them) to JSON like Model.json() does, but much faster"""
+    return orjson.dumps(obj, default=_encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def _state_key(env_state: EnvStateResponse) -> tuple:
+    """Returns the fields of the state (except for the version) as a tuple, which is compared to detect changes"""
+    next_action = env_state.next_action
+    return (
+        env_state.env_state,
+        env_state.schedule_name,
+        None if next_action is None else (next_action.action_type, next_action.action_date_type, next_action.datetime),
+        tuple(
+            (namespace.namespace_name, namespace.state.pods, namespace.state.cpu, namespace.state.memory)
+            for namespace in env_state.namespaces
+        ),
+    )
+
+
+@dataclass
+class _VersionedState:
+    # Fields of the state without the version, used to detect changes
+    key: tuple
+    version: int
+    # JSON of the state with the version, served as is
+    payload: bytes
+
+
+class StateVersions:
+    """
+    Assigns versions to environment states. The version of an environment is increased every time its state changes,
+    the overall version is the version of the latest change. The JSON of every state is encoded once per version.
+
+    Versions start from the current time in milliseconds, so that they keep growing across restarts and a client
+    holding a version from the previous run gets all the environments.
+    """
+
+    def __init__(self) -> None:
+        self.version = int(time.time() * 1000)
+        self._states: dict[str, _VersionedState] = {}
+
+    def update(self, env_states: list[EnvStateResponse]) -> int:
+        """Sets versions of the states (bumping the ones which have changed) and returns the overall version"""
+        for env_state in env_states:
+            # States are encoded only when they change, comparing the fields is much cheaper
+            key = _state_key(env_state)
+            previous = self._states.get(env_state.env_name)
+            if previous is None or previous.key != key:
+                self.version += 1
+                env_state.version = self.version
+                previous = self._states[env_state.env_name] = _VersionedState(
+                    key=key, version=self.version, payload=encode_json(env_state.dict())
+                )
+            env_state.version = previous.version
+        return self.version
+
+    def payload(self, env_name: str) -> bytes:
+        """Returns JSON of the latest state of the environment passed to update()"""
+        return self._states[env_name].payload
+
+
+class StateBroadcaster:
+    """
+    Streams changes of the environments' states to subscribers.
+
+    While there is at least one subscriber, states of all environments are computed once per `interval` seconds
+    (regardless of the number of subscribers) and only the environments whose state has changed are pushed to them.
+    Changes are detected and states are encoded by `versions`, so the subscribers get the same JSON and versions as
+    the other endpoints serve.
+    """
+
+    def __init__(
+        self,
+        get_states: Callable[[], Awaitable[StateAllResponse]],
+        versions: StateVersions,
+        interval: float = 1,
+        keepalive: float = 15,
+        max_pending: int = 16,
+    ) -> None:
+        """
+        :param get_states: returns states of all environments
+        :param versions: assigns versions to the states and keeps their JSON
+        :param interval: period in seconds of checking the states for changes
+        :param keepalive: an empty update is yielded to the subscribers after this number of seconds without changes
+        :param max_pending: a subscriber lagging behind by more updates gets the full state instead of them
+        """
+        self._get_states = get_states
+        self.versions = versions
+        self.interval = interval
+        self.keepalive = keepalive
+        self.max_pending = max_pending
+        self._subscribers: set[asyncio.Queue] = set()
+        # Last published states: {env name: (version, JSON)}
+        self._states: dict[str, tuple[int, bytes]] = {}
+        self._task: asyncio.Task | None = None
+
+    def _publish(self, updates: list[bytes]) -> None:
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(updates)
+            except asyncio.QueueFull:
+                # The subscriber is too slow, let it catch up with the full state at once
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait([payload for _, payload in self._states.values()])
+
+    async def _run(self) -> None:
+        try:
+            while self._subscribers:
+                try:
+                    response = await self._get_states()
+                except Exception as e:
+                    logging.error(f"Failed to get states of the environments: {str(e)}")
+                else:
+                    self.versions.update(response.environments)
+                    updates = []
+                    for env_state in response.environments:
+                        previous = self._states.get(env_state.env_name)
+                        if previous is None or previous[0] != env_state.version:
+                            payload = self.versions.payload(env_state.env_name)
+                            self._states[env_state.env_name] = (env_state.version, payload)
+                            updates.append(payload)
+                    if updates:
+                        self._publish(updates)
+                await asyncio.sleep(self.interval)
+        finally:
+            # States are not tracked without subscribers, the next one starts from scratch
+            self._states = {}
+            self._task = None
+
+    async def subscribe(self) -> AsyncIterator[list[bytes]]:
+        """
+        Yields JSON of the states of all environments first and then of the environments whose state has changed.
+        An empty list is yielded after `keepalive` seconds without changes.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_pending)
+        self._subscribers.add(queue)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        try:
+            if self._states:
+                yield [payload for _, payload in self._states.values()]
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield []
+        finally:
+            self._subscribers.discard(queue)
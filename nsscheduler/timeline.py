@@ -0,0 +1,162 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from heapq import merge
+from typing import Iterator
+
+from nsscheduler.data_models.internal import Action, ActionDateType, ActionType
+from nsscheduler.data_models.scheduler_config import Schedule
+
+WEEK = timedelta(days=7)
+
+
+def _week_start(_date: date) -> date:
+    return _date - timedelta(days=_date.weekday())
+
+
+class CompiledSchedule:
+    """
+    Schedule compiled into a form, which allows to find upcoming actions in O(log n).
+
+    The scheduler still keeps queues of actions expanded by windows (see ActionsCache): the windows are shared by
+    environments with the same schedule and the queues are persisted, so upcoming actions are not generated per call.
+
+    Holidays are merged into a sorted list of disjoint intervals, so that checking whether a moment lies within holidays
+    is a binary search. Weekdays are flattened into a weekly table of occurrences sorted by time since the beginning of
+    the week.
+    """
+
+    def __init__(self, schedule: Schedule) -> None:
+        self.schedule = schedule
+
+        # Holiday intervals [stop, start] merged into disjoint ones
+        self._holiday_stops: list[datetime] = []
+        self._holiday_starts: list[datetime] = []
+        for holiday in sorted(schedule.holidays, key=lambda holiday: holiday.stop):
+            if self._holiday_starts and holiday.stop <= self._holiday_starts[-1]:
+                self._holiday_starts[-1] = max(self._holiday_starts[-1], holiday.start)
+            else:
+                self._holiday_stops.append(holiday.stop)
+                self._holiday_starts.append(holiday.start)
+
+        # Actions at the borders of (not merged) holidays
+        holiday_actions = []
+        for holiday in schedule.holidays:
+            holiday_actions.append(
+                Action(action_type=ActionType.STOP, action_date_type=ActionDateType.HOLIDAY, datetime=holiday.stop)
+            )
+            holiday_actions.append(
+                Action(action_type=ActionType.START, action_date_type=ActionDateType.HOLIDAY, datetime=holiday.start)
+            )
+        self._holiday_actions = sorted(holiday_actions)
+        self._holiday_action_dates = [action.datetime for action in self._holiday_actions]
+
+        # (days since Monday, time, action type), sorted in the order of occurrence within a week
+        weekly: list[tuple[int, time, ActionType]] = []
+        for weekday_entry in schedule.weekdays:
+            for weekday in weekday_entry.days:
+                # we use Monday = 1, Sunday = 7 (while datetime.weekday() returns Monday = 0, Sunday = 6)
+                weekly.extend((weekday - 1, _time, ActionType.STOP) for _time in weekday_entry.stop or [])
+                weekly.extend((weekday - 1, _time, ActionType.START) for _time in weekday_entry.start or [])
+        self._weekly = sorted(weekly, key=lambda entry: (entry[0], entry[1].replace(tzinfo=None), entry[2].value))
+
+    def holiday_end(self, _datetime: datetime) -> datetime | None:
+        """Returns the end of holidays containing _datetime (bounds included) or None if it is not on holidays"""
+        index = bisect_right(self._holiday_stops, _datetime) - 1
+        if index >= 0 and _datetime <= self._holiday_starts[index]:
+            return self._holiday_starts[index]
+        return None
+
+    def is_on_holidays(self, _datetime: datetime) -> bool:
+        return self.holiday_end(_datetime) is not None
+
+    def _iter_holiday_actions(self, starting_from: datetime) -> Iterator[Action]:
+        yield from self._holiday_actions[bisect_left(self._holiday_action_dates, starting_from) :]
+
+    def _iter_weekday_actions(self, starting_from: datetime) -> Iterator[Action]:
+        if not self._weekly:
+            return
+
+        week_start = _week_start(starting_from.date())
+        while True:
+            for weekday, action_time, action_type in self._weekly:
+                candidate_datetime = datetime.combine(week_start + timedelta(days=weekday), action_time)
+                if candidate_datetime < starting_from:
+                    continue
+                holiday_end = self.holiday_end(candidate_datetime)
+                if holiday_end is not None:
+                    if _week_start(holiday_end.date()) > week_start:
+                        # Skip the weeks covered by holidays
+                        week_start = _week_start(holiday_end.date())
+                        break
+                    continue
+                yield Action(
+                    action_type=action_type, action_date_type=ActionDateType.WEEKDAY, datetime=candidate_datetime
+                )
+            else:
+                week_start += WEEK
+
+    def iter_actions(self, starting_from: datetime) -> Iterator[Action]:
+        """
+        Lazily yields actions happening at starting_from or later in the order of occurrence.
+
+        starting_from must be a timezone-aware timestamp.
+        """
+        assert starting_from.tzinfo is not None
+        return merge(self._iter_holiday_actions(starting_from), self._iter_weekday_actions(starting_from))
+
+    def actions_in_interval(self, starting_from: datetime, until: datetime) -> list[Action]:
+        """Returns sorted list of actions within [starting_from, until]"""
+        assert until.tzinfo is not None
+        actions = []
+        for action in self.iter_actions(starting_from):
+            if action.datetime > until:
+                break
+            actions.append(action)
+        return actions
+
+
+_compiled_schedules: dict[int, CompiledSchedule] = {}
+
+
+def compile_schedule(schedule: Schedule) -> CompiledSchedule:
+    """Returns the compiled schedule. Every Schedule object is compiled only once."""
+    compiled = _compiled_schedules.get(id(schedule))
+    # Compare the objects themselves, because ids of garbage collected schedules may be reused
+    if compiled is None or compiled.schedule is not schedule:
+        compiled = _compiled_schedules[id(schedule)] = CompiledSchedule(schedule)
+    return compiled
+
+
+class ActionsCache:
+    """
+    LRU cache of actions_in_interval results keyed by (schedule, window).
+
+    Environments sharing a schedule populate their queues with the same windows, so each distinct schedule is expanded
+    only once per window. The number of stored windows is bounded, so stale windows are evicted in long-running
+    processes.
+    """
+
+    def __init__(self, maxsize: int = 64) -> None:
+        self.maxsize = maxsize
+        self._cache: OrderedDict[tuple[int, datetime, datetime], tuple[Schedule, tuple[Action, ...]]] = OrderedDict()
+
+    def get(self, schedule: Schedule, starting_from: datetime, until: datetime) -> tuple[Action, ...]:
+        key = (id(schedule), starting_from, until)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] is schedule:
+            self._cache.move_to_end(key)
+            return cached[1]
+
+        actions = tuple(compile_schedule(schedule).actions_in_interval(starting_from, until))
+        self._cache[key] = (schedule, actions)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return actions
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+actions_cache = ActionsCache()
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    # Lookups of absent or expired entries
+    misses: int = 0
+    # Entries dropped to keep the cache within maxsize
+    evictions: int = 0
+    # Entries dropped by invalidate() or clear()
+    invalidations: int = 0
+
+
+class TTLCache:
+    """
+    Thread-safe cache, which keeps at most `maxsize` entries for at most `ttl` seconds each. Least recently used entries
+    are evicted first when the cache is full.
+    """
+
+    def __init__(self, ttl: float = 3, maxsize: int = 1024) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # {key: (expiration time, value)}
+        self._entries: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+        self._stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key: Hashable):
+        """Returns the cached value or None if it is absent or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self._stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value) -> None:
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._stats.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stats.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(**vars(self._stats))
@@ -1,12 +1,30 @@
+import asyncio
+import functools
 import logging
 import time
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from decimal import Decimal
 from enum import Enum
+from typing import Callable
 
 import kubernetes
 from kubernetes.utils.quantity import parse_quantity
 
 from nsscheduler.data_models.internal import NamespaceState
+from nsscheduler.dependencies import (
+    DependencyCycleException,
+    WorkloadNode,
+    build_dependency_graph,
+    has_dependency_annotations,
+)
+from nsscheduler.informer import Informer
+from nsscheduler.namespace_resolver import NamespaceResolver
+from nsscheduler.rate_limit import call_api
+from nsscheduler.singleflight import SingleFlight
+from nsscheduler.ttl_cache import TTLCache
 
 
 class NamespaceAction(Enum):
@@ -16,9 +34,64 @@ class NamespaceAction(Enum):
 
 protected_namespaces = ("kube-system",)
 updown_annotation = "ns.scheduler/replicas"
-scale_up_counters: dict[str, int] = {}
-ns_state_cache = {}
-ns_state_cache_update_time = {}
+# States of namespaces listed from the API server. Not used while the informers are synced
+ns_state_cache = TTLCache(ttl=3, maxsize=1024)
+# Coalesces concurrent fetches of namespace states
+state_requests = SingleFlight()
+deployment_informer: Informer | None = None
+stateful_set_informer: Informer | None = None
+namespace_resolver: NamespaceResolver | None = None
+# Workloads, which others depend on, are waited to become ready for at most this number of seconds
+default_ready_timeout = 600
+ready_poll_period = 2
+# The kubernetes client is synchronous, so its calls are offloaded to this pool to keep the event loop responsive
+kube_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="kube")
+
+
+@dataclass
+class ClusterSnapshot:
+    """Namespaces and workloads of the whole cluster captured at one moment"""
+
+    namespaces: list[str]
+    deployments: dict[str, list]
+    stateful_sets: dict[str, list]
+
+    def list_workloads(self, ns: str) -> tuple[list, list]:
+        return self.deployments.get(ns, []), self.stateful_sets.get(ns, [])
+
+
+def workload_key(kind: str, workload) -> str:
+    return f"{kind}/{workload.metadata.namespace}/{workload.metadata.name}"
+
+
+@dataclass
+class ActionJournal:
+    """
+    Progress of an up/down run. Workloads recorded as completed are skipped, so that an interrupted run can be resumed
+    without re-processing (and waiting on batches of) workloads, which were already scaled.
+    """
+
+    completed: set[str] = field(default_factory=set)
+    # Called with the key of every workload completed during the run, e.g. to persist the progress
+    on_completed: Callable[[str], None] | None = None
+
+    def is_completed(self, kind: str, workload) -> bool:
+        return workload_key(kind, workload) in self.completed
+
+    def complete(self, kind: str, workload) -> None:
+        key = workload_key(kind, workload)
+        self.completed.add(key)
+        if self.on_completed is not None:
+            self.on_completed(key)
+
+
+@dataclass
+class PlannedWorkload:
+    kind: str
+    workload: object
+    updater: Callable
+    # Response of the patch applied to the workload by the current run, readiness is only reported once it is observed
+    patched: object | None = None
 
 
 def kube_init(args):
@@ -29,73 +102,446 @@ def kube_init(args):
         kubernetes.config.load_kube_config(context=args.context)
 
 
-def wait_on_batch_full(ns, batch_size, batch_interval):
-    global scale_up_counters
-    scale_up_counters[ns] = scale_up_counters.get(ns, 0) + 1
-    if scale_up_counters[ns] > batch_size and batch_interval > 0:
-        logging.info(f"Waiting {batch_interval} seconds before scaling up next workload in namespace {ns}")
-        time.sleep(batch_interval)
-        scale_up_counters[ns] = 1
+def configure_ns_state_cache(ttl: float, maxsize: int) -> None:
+    """Replaces the cache of namespace states with one of the given TTL (in seconds) and size"""
+    global ns_state_cache
+    ns_state_cache = TTLCache(ttl=ttl, maxsize=maxsize)
+
+
+def configure_kube_executor(max_workers: int) -> None:
+    """Replaces the thread pool used for kubernetes client calls with one of the given size"""
+    global kube_executor
+    kube_executor.shutdown(wait=False)
+    kube_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="kube")
 
 
-async def up(namespaces: list, batch_size: int = 0, batch_timeout: int = 0) -> None:
+async def run_blocking(func, *args, **kwargs):
+    """Runs blocking func (i.e. a kubernetes client call) in the kube_executor without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(kube_executor, functools.partial(func, *args, **kwargs))
+
+
+def start_informers(sync_timeout: float = 60) -> None:
+    """
+    Starts list+watch of namespaces and of Deployments and StatefulSets in all namespaces. Once informers are synced,
+    namespaces and workloads are read from their local stores instead of being listed on every call.
+    """
+    global deployment_informer, stateful_set_informer, namespace_resolver
+
+    app_v1 = kubernetes.client.AppsV1Api()
+    namespace_informer = Informer("Namespace", kubernetes.client.CoreV1Api().list_namespace)
+    deployment_informer = Informer(
+        "Deployment", app_v1.list_deployment_for_all_namespaces, summarize=summarize_workload
+    )
+    stateful_set_informer = Informer(
+        "StatefulSet", app_v1.list_stateful_set_for_all_namespaces, summarize=summarize_workload
+    )
+    namespace_resolver = NamespaceResolver(namespace_informer)
+    for informer in (namespace_informer, deployment_informer, stateful_set_informer):
+        informer.start()
+    for informer in (namespace_informer, deployment_informer, stateful_set_informer):
+        if not informer.wait_for_sync(sync_timeout):
+            logging.warning(f"{informer.kind} informer is not synced yet, falling back to list calls until it is")
+
+
+def informers_synced() -> bool:
+    return all(
+        informer is not None and informer.has_synced() for informer in (deployment_informer, stateful_set_informer)
+    )
+
+
+def list_workloads(ns: str) -> tuple[list, list]:
+    """
+    Returns (deployments, stateful_sets) of the namespace. Workloads are taken from the informers' stores when they are
+    synced, otherwise they are listed from the API server.
+    """
+    if informers_synced():
+        return deployment_informer.list(ns), stateful_set_informer.list(ns)
+
+    app_v1 = kubernetes.client.AppsV1Api()
+    deployments = call_api(app_v1.list_namespaced_deployment, ns, watch=False)
+    stateful_sets = call_api(app_v1.list_namespaced_stateful_set, ns, watch=False)
+    return deployments.items, stateful_sets.items
+
+
+def list_namespaces() -> list[str]:
+    """Returns names of all namespaces, from the namespace informer if it is synced or from the API server otherwise"""
+    if namespace_resolver is not None and namespace_resolver.has_synced():
+        return namespace_resolver.namespaces()
+
+    v1 = kubernetes.client.CoreV1Api()
+    return [ns.metadata.name for ns in call_api(v1.list_namespace).items]
+
+
+def get_workload(kind: str, namespace: str, name: str):
+    """Returns the current version of the workload from the informer's store or from the API server"""
+    if informers_synced():
+        informer = deployment_informer if kind == "Deployment" else stateful_set_informer
+        return informer.get(namespace, name)
+
+    app_v1 = kubernetes.client.AppsV1Api()
+    if kind == "Deployment":
+        return call_api(app_v1.read_namespaced_deployment_status, name, namespace)
+    return call_api(app_v1.read_namespaced_stateful_set_status, name, namespace)
+
+
+def is_workload_ready(workload, patched=None) -> bool:
+    """
+    Returns True if the workload's latest spec is rolled out and all of its replicas are ready.
+
+    :param patched: response of the patch applied to the workload. The workload (e.g. taken from an informer's store,
+        which has not observed the patch yet) is not ready until it reflects the patch.
+    """
+    if workload is None:
+        return True  # deleted workloads are not waited for
+    if patched is not None and (
+        (workload.metadata.generation or 0) < (patched.metadata.generation or 0)
+        or workload.spec.replicas != patched.spec.replicas
+    ):
+        return False
+    status = workload.status
+    if status is None:
+        return workload.spec.replicas == 0
+    return (status.observed_generation or 0) >= (workload.metadata.generation or 0) and (
+        status.ready_replicas or 0
+    ) >= workload.spec.replicas
+
+
+async def wait_until_ready(planned: list[PlannedWorkload], timeout: float = default_ready_timeout) -> bool:
+    """
+    Waits until all the workloads are ready. Returns False if they are still not ready after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(planned)
+    while True:
+        current = await asyncio.gather(
+            *(
+                run_blocking(get_workload, p.kind, p.workload.metadata.namespace, p.workload.metadata.name)
+                for p in pending
+            )
+        )
+        pending = [p for p, workload in zip(pending, current) if not is_workload_ready(workload, p.patched)]
+        if not pending:
+            return True
+        if time.monotonic() >= deadline:
+            logging.warning(
+                f"Workloads {[workload_key(p.kind, p.workload) for p in pending]} are not ready after {timeout} seconds"
+            )
+            return False
+        await asyncio.sleep(ready_poll_period)
+
+
+def take_snapshot() -> ClusterSnapshot:
+    """
+    Captures namespaces and workloads of the whole cluster with one namespace list and (unless the informers are synced)
+    one cluster-wide list call per workload kind.
+    """
+    namespaces = list_namespaces()
+
+    if informers_synced():
+        return ClusterSnapshot(
+            namespaces=namespaces,
+            deployments=deployment_informer.snapshot(),
+            stateful_sets=stateful_set_informer.snapshot(),
+        )
+
+    app_v1 = kubernetes.client.AppsV1Api()
+    deployments = defaultdict(list)
+    for d in call_api(app_v1.list_deployment_for_all_namespaces, watch=False).items:
+        deployments[d.metadata.namespace].append(d)
+    stateful_sets = defaultdict(list)
+    for ss in call_api(app_v1.list_stateful_set_for_all_namespaces, watch=False).items:
+        stateful_sets[ss.metadata.namespace].append(ss)
+    return ClusterSnapshot(namespaces=namespaces, deployments=dict(deployments), stateful_sets=dict(stateful_sets))
+
+
+def workload_requests(workload, replicas: int) -> tuple[Decimal, Decimal]:
+    """Returns total CPU and memory requests of `replicas` pods of the workload"""
+    cpu = Decimal(0)
+    memory = Decimal(0)
+    for c in workload.spec.template.spec.containers:
+        if c.resources.requests:
+            memory += parse_quantity(c.resources.requests.get("memory", 0)) * replicas
+            cpu += parse_quantity(c.resources.requests.get("cpu", 0)) * replicas
+    return cpu, memory
+
+
+def summarize_workload(workload) -> tuple[int, Decimal, Decimal]:
+    """Returns (pods, cpu, memory) requested by the workload at its current scale"""
+    return (workload.spec.replicas, *workload_requests(workload, workload.spec.replicas))
+
+
+def scale_up_requests(workload) -> tuple[Decimal, Decimal]:
+    """Returns CPU and memory requests of the pods, which scaling the workload up would start"""
+    if workload.spec.replicas:
+        # Already running, scaling up leaves it intact
+        return Decimal(0), Decimal(0)
+    return workload_requests(workload, int(workload.metadata.annotations.get(updown_annotation, 1)))
+
+
+async def get_scale_up_requests(namespaces: list) -> tuple[Decimal, Decimal]:
+    """Returns CPU and memory requests of the pods, which scaling the namespaces up would start"""
+    snapshot = await run_blocking(take_snapshot)
+    cpu = Decimal(0)
+    memory = Decimal(0)
+    for ns in resolve_namespaces(namespaces, snapshot.namespaces):
+        deployments, stateful_sets = snapshot.list_workloads(ns)
+        for workload in deployments + stateful_sets:
+            w_cpu, w_memory = scale_up_requests(workload)
+            cpu += w_cpu
+            memory += w_memory
+    return cpu, memory
+
+
+def split_batches(
+    planned: list[PlannedWorkload],
+    size: int = 0,
+    cpu: Decimal | None = None,
+    memory: Decimal | None = None,
+) -> list[list[PlannedWorkload]]:
+    """
+    Splits workloads into consecutive batches of at most `size` workloads, which start pods requesting at most `cpu`
+    cores and `memory` bytes in total. Limits, which are 0 or None, are not applied.
+    """
+    batches: list[list[PlannedWorkload]] = []
+    batch: list[PlannedWorkload] = []
+    batch_cpu = batch_memory = Decimal(0)
+    for p in planned:
+        p_cpu, p_memory = scale_up_requests(p.workload) if cpu or memory else (Decimal(0), Decimal(0))
+        if batch and (
+            (size and len(batch) >= size)
+            or (cpu and batch_cpu + p_cpu > cpu)
+            or (memory and batch_memory + p_memory > memory)
+        ):
+            batches.append(batch)
+            batch = []
+            batch_cpu = batch_memory = Decimal(0)
+        batch.append(p)
+        batch_cpu += p_cpu
+        batch_memory += p_memory
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def _process_workload(
+    action: NamespaceAction,
+    planned: PlannedWorkload,
+    journal: ActionJournal | None,
+    on_patched: Callable[[PlannedWorkload], None] | None = None,
+):
+    result = await run_blocking(modify_workload, action, planned.workload, planned.kind, planned.updater)
+    if result is not None:
+        if result is not planned.workload:
+            planned.patched = result
+            if on_patched is not None:
+                on_patched(planned)
+        if journal is not None:
+            journal.complete(planned.kind, planned.workload)
+
+
+async def _plan_tiers(action: NamespaceAction, namespaces: list) -> list[list[PlannedWorkload]]:
+    """
+    Splits workloads of the namespaces into ordered tiers. Every namespace pattern makes two tiers: one with its
+    StatefulSets and one with its Deployments. Tiers follow the order of the patterns and StatefulSets go before
+    Deployments on UP; both orders are reversed on DOWN.
+    """
+    app_v1 = kubernetes.client.AppsV1Api()
+    all_namespaces = await run_blocking(list_namespaces)
+
+    tiers = []
+    for pattern in namespaces:
+        resolved_namespaces = resolve_namespaces([pattern], all_namespaces)
+        listed = await asyncio.gather(*(run_blocking(list_workloads, ns) for ns in resolved_namespaces))
+        deployments_tier = [
+            PlannedWorkload("Deployment", d, app_v1.patch_namespaced_deployment)
+            for deployments, _ in listed
+            for d in deployments
+        ]
+        stateful_sets_tier = [
+            PlannedWorkload("StatefulSet", ss, app_v1.patch_namespaced_stateful_set)
+            for _, stateful_sets in listed
+            for ss in stateful_sets
+        ]
+        tiers.extend([stateful_sets_tier, deployments_tier])
+
+    if action == NamespaceAction.DOWN:
+        tiers = [list(reversed(tier)) for tier in reversed(tiers)]
+    return tiers
+
+
+async def _run_tiers(
+    action: NamespaceAction,
+    tiers: list[list[PlannedWorkload]],
+    concurrency: int = 1,
+    batch_size: int = 0,
+    batch_timeout: int = 0,
+    journal: ActionJournal | None = None,
+    batch_until_ready: bool = False,
+    batch_cpu: Decimal | None = None,
+    batch_memory: Decimal | None = None,
+    on_patched: Callable[[PlannedWorkload], None] | None = None,
+) -> None:
+    """
+    Processes tiers one after another. Workloads within a tier are patched in parallel, at most `concurrency` at a time,
+    in batches of `batch_size` workloads requesting at most `batch_cpu` and `batch_memory` with `batch_timeout` seconds
+    between them. If `batch_until_ready` is set, the next batch
+    is released as soon as the workloads of the current one are ready, `batch_timeout` being only the upper bound.
+    `on_patched` is called with every workload once it is patched.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(planned: PlannedWorkload):
+        async with semaphore:
+            await _process_workload(action, planned, journal, on_patched)
+
+    for tier in tiers:
+        pending = []
+        for planned in tier:
+            if journal is not None and journal.is_completed(planned.kind, planned.workload):
+                logging.debug(f"Skipping {workload_key(planned.kind, planned.workload)}, it was done by a previous run")
+            else:
+                pending.append(planned)
+
+        if batch_timeout > 0 and (batch_size > 0 or batch_cpu or batch_memory):
+            batches = split_batches(pending, batch_size, batch_cpu, batch_memory)
+        else:
+            batches = [pending]
+
+        for index, batch in enumerate(batches):
+            if index > 0:
+                if batch_until_ready:
+                    logging.info(f"Waiting up to {batch_timeout} seconds for the batch of workloads to become ready")
+                    await wait_until_ready(batches[index - 1], batch_timeout)
+                else:
+                    logging.info(f"Waiting {batch_timeout} seconds before processing next batch of workloads")
+                    await asyncio.sleep(batch_timeout)
+            await asyncio.gather(*(process(planned) for planned in batch))
+
+
+async def _run_dependency_graph(
+    planned: list[PlannedWorkload],
+    dependencies: dict[str, set[str]],
+    concurrency: int = 1,
+    journal: ActionJournal | None = None,
+    ready_timeout: float = default_ready_timeout,
+    on_patched: Callable[[PlannedWorkload], None] | None = None,
+) -> None:
+    """
+    Starts every workload as soon as all of its dependencies are ready, so that the total startup time is defined by
+    the critical path of the graph and not by the number of workloads.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    ready = {key: asyncio.Event() for key in dependencies}
+    depended_upon = set().union(*dependencies.values())
+
+    async def start(p: PlannedWorkload):
+        key = workload_key(p.kind, p.workload)
+        await asyncio.gather(*(ready[dependency].wait() for dependency in dependencies[key]))
+        if journal is None or not journal.is_completed(p.kind, p.workload):
+            async with semaphore:
+                await _process_workload(NamespaceAction.UP, p, journal, on_patched)
+        if key in depended_upon:
+            await wait_until_ready([p], ready_timeout)
+        ready[key].set()
+
+    await asyncio.gather(*(start(p) for p in planned))
+
+
+async def up(
+    namespaces: list,
+    batch_size: int = 0,
+    batch_timeout: int = 0,
+    journal: ActionJournal | None = None,
+    concurrency: int = 1,
+    ready_timeout: float = default_ready_timeout,
+    batch_until_ready: bool = False,
+    batch_cpu: Decimal | None = None,
+    batch_memory: Decimal | None = None,
+    on_patched: Callable[[PlannedWorkload], None] | None = None,
+) -> None:
     """
     Start up resources from the namespaces listed in batches with timeout between batches
     If batch_size or batch_timeout are 0 then no batching applied and all the resources are
     started at once. Namespaces will be processed in the order of the list.
+    If batch_until_ready is set, the next batch is started as soon as the previous one is ready
+    (but no later than batch_timeout).
+
+    If any of the workloads has ns.scheduler/depends-on or ns.scheduler/tier annotations, the workloads are started
+    according to the dependency graph instead: every workload is started once its dependencies are ready,
+    independently of the namespace order and batching.
 
     :param namespaces: list of namespace names possibly specified with regexps
     :param batch_size: number of resources to scale up simultaneously
     :param batch_timeout: delay in seconds between batches
+    :param journal: if provided, workloads completed by a previous run are skipped and progress is recorded to it
+    :param concurrency: number of workloads patched in parallel within a namespace pattern
+    :param ready_timeout: maximum time in seconds to wait for a dependency to become ready
+    :param batch_until_ready: wait for batches to become ready instead of waiting for a fixed batch_timeout
+    :param batch_cpu: maximum CPU requests (in cores) of the pods started by a batch
+    :param batch_memory: maximum memory requests (in bytes) of the pods started by a batch
+    :param on_patched: called with every workload once it is scaled up
     """
     logging.debug(f"Starting up namespaces: {namespaces}")
 
-    app_v1 = kubernetes.client.AppsV1Api()
-
-    for ns in resolve_namespaces(namespaces):
-        deployments = app_v1.list_namespaced_deployment(ns, watch=False)
-        stateful_sets = app_v1.list_namespaced_stateful_set(ns, watch=False)
-
-        logging.info(f"Starting up namespace '{ns}'")
+    tiers = await _plan_tiers(NamespaceAction.UP, namespaces)
 
-        for ss in stateful_sets.items:
-            wait_on_batch_full(ns, batch_size, batch_timeout)
-            modify_workload(NamespaceAction.UP, ss, "StatefulSet", app_v1.patch_namespaced_stateful_set)
-        for d in deployments.items:
-            wait_on_batch_full(ns, batch_size, batch_timeout)
-            modify_workload(NamespaceAction.UP, d, "Deployment", app_v1.patch_namespaced_deployment)
-
-
-async def down(namespaces: list) -> None:
+    planned = [p for tier in tiers for p in tier]
+    if any(has_dependency_annotations(p.workload.metadata.annotations) for p in planned):
+        try:
+            dependencies = build_dependency_graph(
+                [
+                    WorkloadNode(
+                        key=workload_key(p.kind, p.workload),
+                        namespace=p.workload.metadata.namespace,
+                        name=p.workload.metadata.name,
+                        annotations=p.workload.metadata.annotations or {},
+                    )
+                    for p in planned
+                ]
+            )
+        except DependencyCycleException as e:
+            logging.error(f"{str(e)}. Falling back to namespace order")
+        else:
+            await _run_dependency_graph(planned, dependencies, concurrency, journal, ready_timeout, on_patched)
+            return
+
+    await _run_tiers(
+        NamespaceAction.UP,
+        tiers,
+        concurrency,
+        batch_size,
+        batch_timeout,
+        journal,
+        batch_until_ready,
+        batch_cpu,
+        batch_memory,
+        on_patched,
+    )
+
+
+async def down(namespaces: list, journal: ActionJournal | None = None, concurrency: int = 1) -> None:
     """
     Shut down resources from the namespaces listed. Namespaces will be processed in
     reverse order.
 
     :param namespaces: list of namespace names possibly specified with regexps
+    :param journal: if provided, workloads completed by a previous run are skipped and progress is recorded to it
+    :param concurrency: number of workloads patched in parallel within a namespace pattern
     """
     logging.debug(f"Shutting down namespaces: {namespaces}")
 
-    app_v1 = kubernetes.client.AppsV1Api()
-
-    for ns in reversed(resolve_namespaces(namespaces)):
-        logging.info(f"Shut down namespace '{ns}'")
+    tiers = await _plan_tiers(NamespaceAction.DOWN, namespaces)
+    await _run_tiers(NamespaceAction.DOWN, tiers, concurrency, journal=journal)
 
-        deployments = app_v1.list_namespaced_deployment(ns, watch=False)
-        stateful_sets = app_v1.list_namespaced_stateful_set(ns, watch=False)
 
-        for d in deployments.items:
-            modify_workload(NamespaceAction.DOWN, d, "Deployment", app_v1.patch_namespaced_deployment)
-        for ss in stateful_sets.items:
-            modify_workload(NamespaceAction.DOWN, ss, "StatefulSet", app_v1.patch_namespaced_stateful_set)
-
-
-def resolve_namespaces(namespaces: list) -> list:
+def resolve_namespaces(namespaces: list, all_namespaces: list[str] | None = None) -> list:
     """
     Resolve Namespaces
 
     This method takes a list of namespace patterns and returns a list of resolved namespaces that match the patterns.
 
     :param namespaces: A list of namespace patterns to resolve.
+    :param all_namespaces: Names of the existing namespaces. Listed from the API server if not provided.
     :return: A list of resolved namespaces.
 
     Example Usage:
@@ -111,9 +557,13 @@ def resolve_namespaces(namespaces: list) -> list:
     ['default', 'test-1', 'test-2']
     ```
     """
-    v1 = kubernetes.client.CoreV1Api()
-    ns_list = v1.list_namespace()
-    all_namespaces = [ns.metadata.name for ns in ns_list.items]
+    if namespace_resolver is not None and namespace_resolver.has_synced():
+        if all_namespaces is None:
+            return namespace_resolver.resolve(namespaces)
+        return namespace_resolver.compile(namespaces).resolve(all_namespaces)
+
+    if all_namespaces is None:
+        all_namespaces = list_namespaces()
 
     resolved_namespaces = []
     for pattern in namespaces:
@@ -123,53 +573,90 @@ def resolve_namespaces(namespaces: list) -> list:
     return resolved_namespaces
 
 
-async def get_state(namespaces: list) -> dict[str, NamespaceState]:
+def namespace_totals(ns: str) -> tuple[int, Decimal, Decimal]:
+    """Returns (pods, cpu, memory) requested by the workloads of the namespace. Informers must be synced."""
+    pods, cpu, memory = 0, Decimal(0), Decimal(0)
+    for informer in (deployment_informer, stateful_set_informer):
+        totals = informer.totals(ns)
+        if totals is not None:
+            pods += totals[0]
+            cpu += totals[1]
+            memory += totals[2]
+    return pods, cpu, memory
+
+
+def _sum_workloads(workloads) -> tuple[int, Decimal, Decimal]:
+    replicas = 0
+    cpu = Decimal(0)
+    memory = Decimal(0)
+    for d in workloads:
+        d_replicas, d_cpu, d_memory = summarize_workload(d)
+        replicas += d_replicas
+        cpu += d_cpu
+        memory += d_memory
+    return replicas, cpu, memory
+
+
+def _namespace_state(deployments: list, stateful_sets: list) -> NamespaceState:
+    d_replicas, d_cpu, d_memory = _sum_workloads(deployments)
+    s_replicas, s_cpu, s_memory = _sum_workloads(stateful_sets)
+    return NamespaceState(pods=d_replicas + s_replicas, cpu=d_cpu + s_cpu, memory=d_memory + s_memory)
+
+
+async def _fetch_namespace_state(ns: str) -> NamespaceState:
+    ns_state = _namespace_state(*await run_blocking(list_workloads, ns))
+    ns_state_cache.set(ns, ns_state)
+    return ns_state
+
+
+async def get_state(namespaces: list, snapshot: ClusterSnapshot | None = None) -> dict[str, NamespaceState]:
     """
     Returns current state of the namespaces.
 
     :param namespaces: list of namespace names possibly specified with regexps
+    :param snapshot: if provided, the state is computed from the snapshot without any API calls (unless the informers
+        are synced, then the state is always taken from their per-namespace totals)
     """
     logging.debug(f"Getting state of namespaces: {namespaces}")
 
-    def sum(workloads):
-        replicas = 0
-        cpu = 0
-        memory = 0
-        for d in workloads:
-            replicas += d.spec.replicas
-            for c in d.spec.template.spec.containers:
-                if c.resources.requests:
-                    memory += parse_quantity(c.resources.requests.get("memory", 0)) * d.spec.replicas
-                    cpu += parse_quantity(c.resources.requests.get("cpu", 0)) * d.spec.replicas
-
-        return replicas, cpu, memory
-
-    app_v1 = kubernetes.client.AppsV1Api()
-
     state = {}
 
-    for ns in resolve_namespaces(namespaces):
-        if ns in ns_state_cache:
-            if ns_state_cache_update_time[ns] + 3 > time.time():
+    if snapshot is not None:
+        resolved_namespaces = resolve_namespaces(namespaces, snapshot.namespaces)
+    elif namespace_resolver is not None and namespace_resolver.has_synced():
+        resolved_namespaces = resolve_namespaces(namespaces)
+    else:
+        # Concurrent requests share a single list call
+        all_namespaces = await state_requests.do("namespaces", run_blocking, list_namespaces)
+        resolved_namespaces = resolve_namespaces(namespaces, all_namespaces)
+
+    synced = informers_synced()
+    for ns in resolved_namespaces:
+        if synced:
+            # Totals are maintained by the informers incrementally, so workloads are not iterated
+            pods, cpu, memory = namespace_totals(ns)
+            state[ns] = NamespaceState(pods=pods, cpu=cpu, memory=memory)
+        elif snapshot is not None:
+            state[ns] = _namespace_state(*snapshot.list_workloads(ns))
+        else:
+            # Informers are always up to date, so the cache is only needed when we have to call the API server
+            cached = ns_state_cache.get(ns)
+            if cached is not None:
                 logging.debug(f"Getting cached state of namespace '{ns}'")
-                state[ns] = ns_state_cache[ns]
-                continue
-
-        deployments = app_v1.list_namespaced_deployment(ns, watch=False)
-        stateful_sets = app_v1.list_namespaced_stateful_set(ns, watch=False)
-
-        d_replicas, d_cpu, d_memory = sum(deployments.items)
-        s_replicas, s_cpu, s_memory = sum(stateful_sets.items)
-
-        state[ns] = NamespaceState(pods=d_replicas + s_replicas, cpu=d_cpu + s_cpu, memory=d_memory + s_memory)
-        ns_state_cache[ns] = state[ns]
-        ns_state_cache_update_time[ns] = time.time()
+                state[ns] = cached
+            else:
+                # Concurrent requests for the namespace (e.g. from several dashboards) share a single fetch
+                state[ns] = await state_requests.do(("namespace", ns), _fetch_namespace_state, ns)
 
     logging.info(f"State: '{state}'")
     return state
 
 
 def modify_workload(action: NamespaceAction, workload, kind: str, updater):
+    """
+    Scales the workload according to the action. Returns the patched workload as returned by the API server, the
+    workload itself if it was left intact or None if it could not be updated.
+    """
     current_replicas = workload.spec.replicas
     before_down_replicas = int(workload.metadata.annotations.get(updown_annotation, 1))
     desired_replicas = current_replicas
@@ -188,20 +675,25 @@ def modify_workload(action: NamespaceAction, workload, kind: str, updater):
 
     if patch:
         try:
-            updater(name=workload.metadata.name, namespace=workload.metadata.namespace, body=patch, pretty="true")
+            patched = call_api(
+                updater, name=workload.metadata.name, namespace=workload.metadata.namespace, body=patch, pretty="true"
+            )
             logging.info(
                 f"{kind} '{workload.metadata.namespace}/{workload.metadata.name}' was"
                 f" scaled to {desired_replicas} replicas"
             )
+            ns_state_cache.invalidate(workload.metadata.namespace)
+            return patched
         except Exception as e:
             logging.error(
                 f"Failed to update {kind} " f"'{workload.metadata.namespace}/{workload.metadata.name}': {str(e)}"
             )
-    else:
-        logging.info(
-            f"{kind} '{workload.metadata.namespace}/{workload.metadata.name}' was left intact"
-            f" ({current_replicas} replicas)."
-        )
+            return None
+    logging.info(
+        f"{kind} '{workload.metadata.namespace}/{workload.metadata.name}' was left intact"
+        f" ({current_replicas} replicas)."
+    )
+    return workload
 
 
 # def select_namespaces(namespaces: list) -> list:
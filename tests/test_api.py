@@ -0,0 +1,179 @@
+import re
+
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+
+from nsscheduler import api
+from nsscheduler.data_models.api import (
+    EnvironmentState,
+    EnvStateResponse,
+    StateAllResponse,
+)
+from nsscheduler.data_models.internal import ActionType
+from nsscheduler.data_models.scheduler_config import Config, Schedule
+from nsscheduler.scheduler import (
+    AnotherActionIsInProgressException,
+    WrongEnvNameException,
+)
+
+CONFIG = """
+schedules:
+  main:
+    timezone: UTC
+    weekdays:
+      - days: [1,2,3,4,5]
+        start: 08:00
+        stop: 20:00
+envs:
+  env-1:
+    namespaces: [ns-1]
+    schedule: main
+  env-2:
+    namespaces: [ns-2]
+    schedule: main
+"""
+
+
+@pytest.fixture
+def env_states(monkeypatch):
+    """{env name: state}. /state_all and /state/{env_name} return the current content"""
+    states = {"env-1": EnvironmentState.DOWN, "env-2": EnvironmentState.DOWN}
+
+    def make_response(env_name: str) -> EnvStateResponse:
+        return EnvStateResponse(
+            env_name=env_name, env_state=states[env_name], schedule_name="main", next_action=None, namespaces=[]
+        )
+
+    async def get_all_env_states():
+        return StateAllResponse(environments=[make_response(env_name) for env_name in states])
+
+    async def get_env_states(env_names: list[str]):
+        return [make_response(env_name) for env_name in env_names]
+
+    async def get_env_state(env_name: str):
+        return make_response(env_name)
+
+    async def add_manual_action_to_queue(env_name: str, action_type: ActionType, wait_started: bool = True):
+        if env_name not in states:
+            raise WrongEnvNameException
+        if env_name == "broken":
+            raise RuntimeError("database is locked")
+        if states[env_name] == EnvironmentState.ACTION_IN_PROGRESS:
+            raise AnotherActionIsInProgressException
+        states[env_name] = EnvironmentState.ACTION_IN_PROGRESS
+
+    def list_env_names(name_prefix=None, name_regex=None, schedule_name=None):
+        return [
+            env_name
+            for env_name in sorted(states)
+            if (name_prefix is None or env_name.startswith(name_prefix))
+            and (name_regex is None or re.search(name_regex, env_name))
+            and schedule_name in (None, "main")
+        ]
+
+    monkeypatch.setattr(api.scheduler, "get_all_env_states", get_all_env_states)
+    monkeypatch.setattr(api.scheduler, "get_env_states", get_env_states)
+    monkeypatch.setattr(api.scheduler, "get_env_state", get_env_state)
+    monkeypatch.setattr(api.scheduler, "list_env_names", list_env_names)
+    monkeypatch.setattr(api.scheduler, "add_manual_action_to_queue", add_manual_action_to_queue)
+    monkeypatch.setattr(api.scheduler, "get_schedules", lambda: Config(**yaml.safe_load(CONFIG)).schedules)
+    monkeypatch.setattr(api, "schedules_payload", None)
+    monkeypatch.setattr(api, "state_versions", api.StateVersions())
+    return states
+
+
+def test_state_all_conditional_and_delta_requests(env_states):
+    client = TestClient(api.app)
+
+    response = client.get("/state_all")
+    assert response.status_code == 200
+    etag, version = response.headers["ETag"], response.json()["version"]
+    assert len(response.json()["environments"]) == 2
+
+    assert client.get("/state_all", headers={"If-None-Match": etag}).status_code == 304
+    delta = client.get("/state_all", headers={"If-None-Match": etag}, params={"since": version})
+    assert delta.status_code == 200
+    assert delta.json()["environments"] == []
+    assert delta.headers["ETag"] != etag
+
+    env_states["env-2"] = EnvironmentState.UP
+    response = client.get("/state_all", headers={"If-None-Match": etag}, params={"since": version})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert [env["env_name"] for env in response.json()["environments"]] == ["env-2"]
+
+    response = client.get("/state/env-2")
+    assert client.get("/state/env-2", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+
+def test_state_all_filters_and_pages(env_states):
+    env_states.update({"env-3": EnvironmentState.UP, "test-1": EnvironmentState.UP})
+    client = TestClient(api.app)
+
+    def env_names(response) -> list[str]:
+        return [env["env_name"] for env in response.json()["environments"]]
+
+    assert env_names(client.get("/state_all", params={"name_prefix": "env-", "state": "Up"})) == ["env-3"]
+    assert env_names(client.get("/state_all", params={"name_regex": "-1$"})) == ["env-1", "test-1"]
+    assert env_names(client.get("/state_all", params={"schedule": "other"})) == []
+    assert client.get("/state_all", params={"name_regex": "("}).status_code == 422
+
+    pages, params = [], {"limit": 2}
+    while True:
+        response = client.get("/state_all", params=params).json()
+        pages.append([env["env_name"] for env in response["environments"]])
+        if response["continue"] is None:
+            break
+        params["continue"] = response["continue"]
+    assert pages == [["env-1", "env-2"], ["env-3", "test-1"]]
+
+    response = client.get("/state_all", params={"state": "Up", "limit": 1, "summary": True}).json()
+    assert response["environments"][0]["env_name"] == "env-3"
+    assert response["environments"][0]["pods"] == 0
+    assert "namespaces" not in response["environments"][0]
+    assert response["continue"] == "env-3"
+
+
+def test_schedules_are_served_separately(env_states):
+    client = TestClient(api.app)
+
+    env_state = client.get("/state/env-1").json()
+    assert env_state["schedule_name"] == "main"
+
+    response = client.get("/schedules")
+    schedule = Schedule(**response.json()[env_state["schedule_name"]])
+    assert schedule.json() == Config(**yaml.safe_load(CONFIG)).schedules["main"].json()
+    assert client.get("/schedules", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+
+def test_bulk_actions_report_per_env_results(env_states):
+    env_states.update({"env-3": EnvironmentState.UP, "env-4": EnvironmentState.ACTION_IN_PROGRESS})
+    client = TestClient(api.app)
+
+    response = client.post("/bulk/down", json={"name_prefix": "env-"})
+    assert response.status_code == 200
+    assert [(result["env_name"], result["status"]) for result in response.json()["results"]] == [
+        ("env-1", "skipped"),
+        ("env-2", "skipped"),
+        ("env-3", "scheduled"),
+        ("env-4", "failed"),
+    ]
+
+    results = client.post("/bulk/up", json={"env_names": ["env-1", "unknown", "env-1"]}).json()["results"]
+    assert [(result["env_name"], result["status"]) for result in results] == [
+        ("env-1", "scheduled"),
+        ("unknown", "failed"),
+    ]
+    assert results[1]["detail"] == "There are no environments with such name"
+
+    # An unexpected failure of one environment is reported along with the results of the others
+    env_states["broken"] = EnvironmentState.UP
+    results = client.post("/bulk/up", json={"env_names": ["broken", "env-2"]}).json()["results"]
+    assert [(result["env_name"], result["status"], result["detail"]) for result in results] == [
+        ("broken", "failed", "database is locked"),
+        ("env-2", "scheduled", None),
+    ]
+
+    assert client.post("/bulk/up", json={}).status_code == 422
+    assert client.post("/bulk/up", json={"env_names": ["env-1"], "name_prefix": "env-"}).status_code == 422
@@ -0,0 +1,65 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+from nsscheduler import capacity
+
+
+@pytest.mark.asyncio
+async def test_capacity_gate_reserves_admitted_resources(monkeypatch):
+    monkeypatch.setattr(capacity, "get_free_resources", lambda: (Decimal(10), Decimal(2**35)))
+    gate = capacity.CapacityGate(max_wait=60, poll_period=60)
+    admitted = []
+    finish_first = asyncio.Event()
+
+    async def start(name: str, cpu: int):
+        async with gate.admit(name, Decimal(cpu), Decimal(2**30)):
+            admitted.append(name)
+            if name == "first":
+                await finish_first.wait()
+
+    first = asyncio.create_task(start("first", 8))
+    await asyncio.sleep(0.01)
+    # 4 cores do not fit next to the 8 reserved ones, while 2 cores do
+    big = asyncio.create_task(start("big", 4))
+    small = asyncio.create_task(start("small", 2))
+    await asyncio.sleep(0.01)
+    assert admitted == ["first", "small"]
+
+    finish_first.set()
+    await asyncio.wait_for(asyncio.gather(first, big, small), timeout=5)
+    assert admitted == ["first", "small", "big"]
+
+
+@pytest.mark.asyncio
+async def test_reservation_is_released_as_pods_are_created(monkeypatch):
+    monkeypatch.setattr(capacity, "get_free_resources", lambda: (Decimal(10), Decimal(2**35)))
+    gate = capacity.CapacityGate(max_wait=60, poll_period=60)
+    admitted = []
+    scaled_up = asyncio.Event()
+    finish_first = asyncio.Event()
+
+    async def first():
+        async with gate.admit("first", Decimal(8), Decimal(0)) as reservation:
+            await scaled_up.wait()
+            # Half of the pods are created, the listed requests account for them from now on
+            reservation.release(Decimal(4), Decimal(0))
+            await finish_first.wait()
+
+    async def second():
+        async with gate.admit("second", Decimal(4), Decimal(0)):
+            admitted.append("second")
+
+    tasks = [asyncio.create_task(first())]
+    await asyncio.sleep(0.01)
+    tasks.append(asyncio.create_task(second()))
+    await asyncio.sleep(0.01)
+    assert admitted == []
+
+    scaled_up.set()
+    await asyncio.sleep(0.01)
+    assert admitted == ["second"]
+
+    finish_first.set()
+    await asyncio.wait_for(asyncio.gather(*tasks), timeout=5)
@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+from kubernetes.client.exceptions import ApiException
+
+from nsscheduler import informer as informer_module
+from nsscheduler.informer import Informer
+
+
+def make_object(namespace: str, name: str, resource_version: str, replicas: int) -> SimpleNamespace:
+    return SimpleNamespace(
+        metadata=SimpleNamespace(namespace=namespace, name=name, resource_version=resource_version),
+        spec=SimpleNamespace(replicas=replicas),
+    )
+
+
+def test_totals_are_updated_incrementally():
+    summarized = []
+
+    def summarize(obj):
+        summarized.append((obj.metadata.name, obj.metadata.resource_version))
+        return (obj.spec.replicas, obj.spec.replicas * 2)
+
+    listed = [make_object("ns-1", "a", "1", 1), make_object("ns-1", "b", "2", 2), make_object("ns-2", "c", "3", 3)]
+    informer = Informer(
+        "Deployment",
+        lambda watch: SimpleNamespace(items=listed, metadata=SimpleNamespace(resource_version="3")),
+        summarize=summarize,
+    )
+    informer._relist()
+    assert informer.totals("ns-1") == (3, 6)
+    assert informer.totals("ns-2") == (3, 6)
+
+    informer._apply_event("MODIFIED", make_object("ns-1", "a", "4", 5))
+    informer._apply_event("DELETED", make_object("ns-2", "c", "5", 3))
+    assert informer.totals("ns-1") == (7, 14)
+    assert informer.totals("ns-2") is None
+
+    # Summaries of unchanged objects are reused on relist
+    summarized.clear()
+    listed = [make_object("ns-1", "a", "4", 5), make_object("ns-1", "b", "2", 2)]
+    informer._relist()
+    assert summarized == []
+    assert informer.totals("ns-1") == (7, 14)
+
+
+def test_watch_resumes_and_relists_on_gone(monkeypatch):
+    lists = [
+        SimpleNamespace(items=[make_object("ns-1", "a", "1", 1)], metadata=SimpleNamespace(resource_version="1")),
+        SimpleNamespace(
+            items=[make_object("ns-1", "a", "9", 2), make_object("ns-1", "b", "10", 1)],
+            metadata=SimpleNamespace(resource_version="10"),
+        ),
+    ]
+    watched_from = []
+    seen = []
+
+    def first_watch():
+        yield {"type": "MODIFIED", "object": make_object("ns-1", "a", "2", 3)}
+        yield {"type": "BOOKMARK", "object": make_object("ns-1", "bookmark", "3", 0)}
+        # The server-side timeout ends the stream
+
+    def second_watch():
+        seen.append(sorted(obj.metadata.name for obj in informer.list("ns-1")))
+        raise ApiException(status=410, reason="Gone")
+        yield
+
+    def third_watch():
+        informer.stop()
+        yield from ()
+
+    streams = iter([first_watch, second_watch, third_watch])
+
+    class FakeWatch:
+        def __init__(self):
+            self.resource_version = None
+
+        def stream(self, func, resource_version, **kwargs):
+            watched_from.append(resource_version)
+            for event in next(streams)():
+                self.resource_version = event["object"].metadata.resource_version
+                yield event
+
+        def stop(self):
+            pass
+
+    monkeypatch.setattr(informer_module.kubernetes.watch, "Watch", FakeWatch)
+    informer = Informer("Deployment", lambda watch: lists.pop(0), retry_period=0)
+    informer._run()
+
+    # A timed out watch resumes from the last seen resourceVersion (advanced by the bookmark), 410 Gone re-lists
+    assert watched_from == ["1", "3", "10"]
+    assert lists == []
+    # Bookmarks do not add objects
+    assert seen == [["a"]]
+    assert [(obj.metadata.name, obj.spec.replicas) for obj in informer.list("ns-1")] == [("a", 2), ("b", 1)]
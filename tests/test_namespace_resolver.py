@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+from nsscheduler.informer import Informer
+from nsscheduler.namespace_resolver import NamespaceResolver
+
+
+def make_namespace(name: str) -> SimpleNamespace:
+    return SimpleNamespace(metadata=SimpleNamespace(namespace=None, name=name))
+
+
+def make_informer(names: list[str]) -> Informer:
+    def list_namespace(watch: bool = False):
+        return SimpleNamespace(
+            items=[make_namespace(name) for name in names], metadata=SimpleNamespace(resource_version="1")
+        )
+
+    informer = Informer("Namespace", list_namespace)
+    informer._relist()
+    return informer
+
+
+def test_resolve_keeps_pattern_order():
+    resolver = NamespaceResolver(make_informer(["default", "test-2", "test-1", "vasya-apps", "vasya-data"]))
+
+    assert resolver.resolve(["vasya-data", "vasya-apps"]) == ["vasya-data", "vasya-apps"]
+    assert resolver.resolve(["default", "test-.*"]) == ["default", "test-1", "test-2"]
+    assert resolver.resolve(["test-1|vasya-a.*"]) == ["test-1", "vasya-apps"]
+
+
+def test_resolve_is_invalidated_by_namespace_changes():
+    informer = make_informer(["test-1"])
+    resolver = NamespaceResolver(informer)
+    assert resolver.resolve(["test-.*"]) == ["test-1"]
+
+    informer._apply_event("ADDED", make_namespace("test-2"))
+    assert resolver.resolve(["test-.*"]) == ["test-1", "test-2"]
+
+    informer._apply_event("DELETED", make_namespace("test-1"))
+    assert resolver.resolve(["test-.*"]) == ["test-2"]
@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+import pytest
+from kubernetes.client.exceptions import ApiException
+
+from nsscheduler import rate_limit
+
+
+def test_token_bucket_limits_rate():
+    bucket = rate_limit.TokenBucket(qps=100, burst=5)
+    started = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # 5 calls are served by the burst, the other 10 take at least 0.1 seconds at 100 qps
+    assert time.monotonic() - started >= 0.09
+
+
+def test_call_api_retries_throttled_requests(monkeypatch):
+    monkeypatch.setattr(rate_limit, "api_retry_backoff", 0)
+    calls = []
+
+    def patch(status):
+        calls.append(status)
+        if len(calls) < 3:
+            raise ApiException(status=status)
+        return "patched"
+
+    assert rate_limit.call_api(patch, 429) == "patched"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(ApiException):
+        rate_limit.call_api(patch, 404)
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_admission_queue_admits_by_priority():
+    queue = rate_limit.AdmissionQueue(max_concurrent=1)
+    admitted = []
+    release = asyncio.Event()
+
+    async def action(name: str, priority: int):
+        async with queue.admit(priority):
+            admitted.append(name)
+            await release.wait()
+
+    first = asyncio.create_task(action("first", 2))
+    await asyncio.sleep(0)
+    others = [asyncio.create_task(action("weekday", 2)), asyncio.create_task(action("manual", 0))]
+    await asyncio.sleep(0)
+    assert admitted == ["first"]
+
+    release.set()
+    await asyncio.gather(first, *others)
+    assert admitted == ["first", "manual", "weekday"]
@@ -1,23 +1,29 @@
-# import asyncio
+import asyncio
 import datetime
 
 # import logging
 import typing
+from collections import Counter
 from dataclasses import dataclass
+from decimal import Decimal
+from types import SimpleNamespace
 
 import pytest
 import pytz
 import yaml
 
-# from nsscheduler import scheduler, updown
+from nsscheduler import capacity, scheduler, updown
+
 # from nsscheduler.data_models.api import NamespaceState
 from nsscheduler.data_models.scheduler_config import Config
+from nsscheduler.rate_limit import AdmissionQueue
 from nsscheduler.scheduler import (  # schedule_env,
     Action,
     ActionDateType,
     ActionType,
     get_actions_in_interval,
 )
+from nsscheduler.timeline import ActionsCache, compile_schedule
 
 
 @dataclass
@@ -161,6 +167,43 @@ def test_get_actions_in_interval(case: GetActionsInIntervalTestCase):
     ] == case.ground_truth
 
 
+def test_iter_actions():
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    compiled = compile_schedule(config.schedules["main"])
+
+    def utc(timestamp: str) -> datetime.datetime:
+        return datetime.datetime.strptime(timestamp, CONFIG_DATE_FORMAT).replace(tzinfo=pytz.UTC)
+
+    def next_action_after(_datetime: datetime.datetime) -> Action:
+        return next(action for action in compiled.iter_actions(_datetime) if action.datetime > _datetime)
+
+    assert next_action_after(utc("2022-12-17 01:00:00")) == Action(
+        action_type=ActionType.START, action_date_type=ActionDateType.WEEKDAY, datetime=utc("2022-12-17 03:00:00")
+    )
+    # Weekday actions are skipped during holidays
+    assert next_action_after(utc("2022-12-22 23:00:00")) == Action(
+        action_type=ActionType.START, action_date_type=ActionDateType.HOLIDAY, datetime=utc("2023-01-03 08:00:00")
+    )
+    assert next_action_after(utc("2023-01-03 08:00:00")) == Action(
+        action_type=ActionType.STOP, action_date_type=ActionDateType.WEEKDAY, datetime=utc("2023-01-04 01:00:00")
+    )
+    assert compile_schedule(config.schedules["main"]) is compiled
+
+
+def test_actions_cache():
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    schedule = config.schedules["main"]
+    cache = ActionsCache(maxsize=2)
+    starting_from = datetime.datetime(2022, 12, 17, tzinfo=pytz.UTC)
+
+    actions = cache.get(schedule, starting_from, starting_from + datetime.timedelta(days=30))
+    assert cache.get(schedule, starting_from, starting_from + datetime.timedelta(days=30)) is actions
+
+    cache.get(schedule, starting_from, starting_from + datetime.timedelta(days=1))
+    cache.get(schedule, starting_from, starting_from + datetime.timedelta(days=2))
+    assert cache.get(schedule, starting_from, starting_from + datetime.timedelta(days=30)) is not actions
+
+
 T = typing.TypeVar("T")
 
 
@@ -174,6 +217,321 @@ def does_list_contains_elements_in_order(_list: list[T], elements: list[T]) -> b
     return False
 
 
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_run_scheduler(monkeypatch):
+    calls = []
+
+    async def mock_up(namespaces: list, *args, **kwargs) -> None:
+        calls.append(("up", namespaces))
+
+    async def mock_down(namespaces: list, *args, **kwargs) -> None:
+        calls.append(("down", namespaces))
+
+    monkeypatch.setattr(scheduler, "up", mock_up)
+    monkeypatch.setattr(scheduler, "down", mock_down)
+
+    def timestamp_seconds_ahead(seconds: int) -> str:
+        return (datetime.datetime.now(tz=pytz.UTC) + datetime.timedelta(seconds=seconds)).strftime(CONFIG_DATE_FORMAT)
+
+    config = Config(
+        **yaml.safe_load(
+            f"""
+schedules:
+  main:
+    timezone: UTC
+    holidays:
+      - stop: {timestamp_seconds_ahead(1)}
+        start: {timestamp_seconds_ahead(2)}
+envs:
+  test-env-1:
+    namespaces:
+      - test-namespace-1
+    schedule: main
+  test-env-2:
+    namespaces:
+      - test-namespace-2
+    schedule: main
+"""
+        )
+    )
+
+    scheduler._reset_all_env_controllers()
+    for env_name, env in config.envs.items():
+        scheduler.register_env(env, env_name, config.schedules[env.schedule])
+
+    try:
+        async with asyncio.timeout(3):
+            await scheduler.run_scheduler()
+    except TimeoutError:
+        pass
+    finally:
+        scheduler._reset_all_env_controllers()
+
+    assert sorted(calls[:2]) == [("down", ["test-namespace-1"]), ("down", ["test-namespace-2"])]
+    assert sorted(calls[2:]) == [("up", ["test-namespace-1"]), ("up", ["test-namespace-2"])]
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_manual_action_starts_immediately(monkeypatch):
+    up_started = asyncio.Event()
+    release_up = asyncio.Event()
+
+    async def mock_up(namespaces: list, *args, **kwargs) -> None:
+        up_started.set()
+        await release_up.wait()
+
+    monkeypatch.setattr(scheduler, "up", mock_up)
+
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    scheduler._reset_all_env_controllers()
+    scheduler.register_env(config.envs["dev-vasya"], "dev-vasya", config.schedules["main"])
+    scheduler_task = asyncio.create_task(scheduler.run_scheduler())
+    try:
+        action = await scheduler.add_manual_action_to_queue("dev-vasya", ActionType.START)
+        assert action.action_type == ActionType.START
+        assert action.action_date_type == ActionDateType.MANUAL
+        await asyncio.wait_for(up_started.wait(), timeout=1)
+
+        with pytest.raises(scheduler.AnotherActionIsInProgressException):
+            await scheduler.add_manual_action_to_queue("dev-vasya", ActionType.STOP)
+
+        release_up.set()
+        await scheduler._env_controllers["dev-vasya"].executor
+        assert scheduler._env_controllers["dev-vasya"].env_state == scheduler.EnvControllerState.IDLE
+    finally:
+        scheduler_task.cancel()
+        scheduler._reset_all_env_controllers()
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_manual_action_returns_once_admitted(monkeypatch):
+    calls = []
+
+    async def mock_up(namespaces: list, *args, **kwargs) -> None:
+        calls.append("up")
+
+    monkeypatch.setattr(scheduler, "up", mock_up)
+
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    scheduler._reset_all_env_controllers()
+    admission_queue = AdmissionQueue(max_concurrent=1)
+    scheduler.set_admission_queue(admission_queue)
+    scheduler.register_env(config.envs["dev-vasya"], "dev-vasya", config.schedules["main"])
+    try:
+        release = asyncio.Event()
+
+        async def hold_slot():
+            async with admission_queue.admit(0):
+                await release.wait()
+
+        holder = asyncio.create_task(hold_slot())
+        await asyncio.sleep(0)
+        request = asyncio.create_task(scheduler.add_manual_action_to_queue("dev-vasya", ActionType.START))
+        await asyncio.sleep(0.1)
+        assert not request.done()
+
+        release.set()
+        await asyncio.wait_for(request, timeout=1)
+        await holder
+        await scheduler._env_controllers["dev-vasya"].executor
+        assert calls == ["up"]
+
+        # A caller giving up while the action is queued does not cancel the action
+        release.clear()
+        holder = asyncio.create_task(hold_slot())
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(scheduler.add_manual_action_to_queue("dev-vasya", ActionType.START), timeout=0.1)
+        release.set()
+        await holder
+        await scheduler._env_controllers["dev-vasya"].executor
+        assert calls == ["up", "up"]
+
+        # Bulk requests only queue the actions
+        release.clear()
+        holder = asyncio.create_task(hold_slot())
+        await asyncio.sleep(0)
+        await asyncio.wait_for(
+            scheduler.add_manual_action_to_queue("dev-vasya", ActionType.START, wait_started=False), timeout=0.1
+        )
+        assert calls == ["up", "up"]
+        release.set()
+        await holder
+        await scheduler._env_controllers["dev-vasya"].executor
+        assert calls == ["up", "up", "up"]
+    finally:
+        scheduler._reset_all_env_controllers()
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_start_waiting_for_capacity_does_not_hold_admission_slot(monkeypatch):
+    calls = []
+
+    async def mock_down(namespaces: list, *args, **kwargs) -> None:
+        calls.append("down")
+
+    async def get_scale_up_requests(namespaces: list):
+        return Decimal(1), Decimal(0)
+
+    monkeypatch.setattr(scheduler, "down", mock_down)
+    monkeypatch.setattr(scheduler, "get_scale_up_requests", get_scale_up_requests)
+    monkeypatch.setattr(capacity, "get_free_resources", lambda: (Decimal(0), Decimal(0)))
+
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    scheduler._reset_all_env_controllers()
+    scheduler.set_admission_queue(AdmissionQueue(max_concurrent=1))
+    scheduler.set_capacity_gate(capacity.CapacityGate(max_wait=60, poll_period=60))
+    for env_name in ("env-starting", "env-stopping"):
+        scheduler.register_env(config.envs["dev-vasya"], env_name, config.schedules["main"])
+    try:
+        start = asyncio.create_task(scheduler.add_manual_action_to_queue("env-starting", ActionType.START))
+        await asyncio.sleep(0.1)
+        assert not start.done()
+
+        await asyncio.wait_for(scheduler.add_manual_action_to_queue("env-stopping", ActionType.STOP), timeout=1)
+        await scheduler._env_controllers["env-stopping"].executor
+        assert calls == ["down"]
+        start.cancel()
+    finally:
+        scheduler._env_controllers["env-starting"].executor.cancel()
+        scheduler._reset_all_env_controllers()
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_failed_capacity_sizing_does_not_leave_action_in_progress(monkeypatch):
+    async def get_scale_up_requests(namespaces: list):
+        raise RuntimeError("API server is unavailable")
+
+    async def mock_down(namespaces: list, *args, **kwargs) -> None:
+        pass
+
+    monkeypatch.setattr(scheduler, "get_scale_up_requests", get_scale_up_requests)
+    monkeypatch.setattr(scheduler, "down", mock_down)
+
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    scheduler._reset_all_env_controllers()
+    scheduler.set_capacity_gate(capacity.CapacityGate(max_wait=60))
+    env_controller = scheduler.register_env(config.envs["dev-vasya"], "dev-vasya", config.schedules["main"])
+    try:
+        with pytest.raises(RuntimeError):
+            await scheduler.add_manual_action_to_queue("dev-vasya", ActionType.START)
+        await env_controller.executor
+        assert env_controller.env_state == scheduler.EnvControllerState.IDLE
+
+        await scheduler.add_manual_action_to_queue("dev-vasya", ActionType.STOP)
+        await env_controller.executor
+        assert env_controller.env_state == scheduler.EnvControllerState.IDLE
+    finally:
+        scheduler._reset_all_env_controllers()
+
+
+@pytest.mark.asyncio
+async def test_ready_time_is_measured_only_for_scheduled_scale_ups(monkeypatch):
+    scaled = []
+
+    async def mock_up(namespaces: list, *args, on_patched=None, **kwargs) -> None:
+        for planned in scaled:
+            on_patched(planned)
+
+    async def wait_until_ready(planned: list, timeout: float) -> bool:
+        return True
+
+    monkeypatch.setattr(scheduler, "up", mock_up)
+    monkeypatch.setattr(scheduler, "wait_until_ready", wait_until_ready)
+
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    env = config.envs["dev-vasya"].copy(update={"ready_by": True})
+    scheduler._reset_all_env_controllers()
+    env_controller = scheduler.register_env(env, "dev-vasya", config.schedules["main"])
+    try:
+
+        async def start(action_date_type: ActionDateType):
+            env_controller.action_queue.appendleft(
+                Action(
+                    action_type=ActionType.START,
+                    action_date_type=action_date_type,
+                    datetime=datetime.datetime.now(tz=pytz.UTC),
+                )
+            )
+            await scheduler.run_action(env_controller)
+            return env_controller.ready_tracker
+
+        # The environment is already up
+        assert await start(ActionDateType.WEEKDAY) is None
+        scaled.append(updown.PlannedWorkload("Deployment", SimpleNamespace(), None))
+        assert await start(ActionDateType.MANUAL) is None
+
+        tracker = await start(ActionDateType.WEEKDAY)
+        assert tracker is not None
+        await tracker
+        assert env_controller.ready_estimate is not None
+    finally:
+        scheduler._reset_all_env_controllers()
+
+
+@pytest.mark.asyncio
+async def test_all_env_states_take_constant_number_of_list_calls(monkeypatch):
+    calls = Counter()
+
+    def listed(name: str, items: list):
+        def list_func(*args, **kwargs):
+            calls[name] += 1
+            return SimpleNamespace(items=items)
+
+        return list_func
+
+    def workload(namespace: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            metadata=SimpleNamespace(namespace=namespace, name="app"),
+            spec=SimpleNamespace(
+                replicas=1,
+                template=SimpleNamespace(
+                    spec=SimpleNamespace(containers=[SimpleNamespace(resources=SimpleNamespace(requests=None))])
+                ),
+            ),
+        )
+
+    namespaces = [f"ns-{i}" for i in range(10)]
+    core_v1 = SimpleNamespace(
+        list_namespace=listed(
+            "list_namespace", [SimpleNamespace(metadata=SimpleNamespace(name=ns)) for ns in namespaces]
+        )
+    )
+    app_v1 = SimpleNamespace(
+        list_deployment_for_all_namespaces=listed(
+            "list_deployment_for_all_namespaces", [workload(ns) for ns in namespaces]
+        ),
+        list_stateful_set_for_all_namespaces=listed("list_stateful_set_for_all_namespaces", []),
+    )
+    monkeypatch.setattr(updown.kubernetes.client, "CoreV1Api", lambda: core_v1)
+    monkeypatch.setattr(updown.kubernetes.client, "AppsV1Api", lambda: app_v1)
+
+    config = Config(**yaml.safe_load(TEST_CONFIG))
+    scheduler._reset_all_env_controllers()
+    try:
+        for i, ns in enumerate(namespaces):
+            env = config.envs["dev-vasya"].copy(update={"namespaces": [ns]})
+            scheduler.register_env(env, f"env-{i}", config.schedules["main"])
+
+        response = await scheduler.get_all_env_states()
+    finally:
+        scheduler._reset_all_env_controllers()
+
+    assert len(response.environments) == 10
+    assert all(env_state.namespaces[0].state.pods == 1 for env_state in response.environments)
+    # One namespace list and one cluster-wide list per workload kind regardless of the number of environments
+    assert calls == {
+        "list_namespace": 1,
+        "list_deployment_for_all_namespaces": 1,
+        "list_stateful_set_for_all_namespaces": 1,
+    }
+
+
 # TODO: Change test to use custom nsscheduler mocking
 # @pytest.mark.timeout(4 * 3)
 # @pytest.mark.asyncio
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from nsscheduler.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_are_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return f"state of {key}"
+
+    results = await asyncio.gather(*(flight.do(key, fetch, key) for key in ["a", "a", "b", "a"]))
+
+    assert results == ["state of a", "state of a", "state of b", "state of a"]
+    assert calls == ["a", "b"]
+    assert flight.in_flight() == 0
+
+    # Once the call is over, the next one is made anew
+    await flight.do("a", fetch, "a")
+    assert calls == ["a", "b", "a"]
+
+
+@pytest.mark.asyncio
+async def test_exceptions_are_shared():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("API server is unavailable")
+
+    results = await asyncio.gather(flight.do("a", fail), flight.do("a", fail), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
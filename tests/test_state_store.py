@@ -0,0 +1,134 @@
+import datetime
+import sqlite3
+from collections import deque
+
+import pytest
+import pytz
+import yaml
+
+from nsscheduler import scheduler
+from nsscheduler.data_models.internal import Action, ActionDateType, ActionType
+from nsscheduler.data_models.scheduler_config import Config
+from nsscheduler.state_store import StateStore
+
+CONFIG = """
+schedules:
+  main:
+    timezone: UTC
+    weekdays:
+      - days: [1,2,3,4,5,6,7]
+        start: 08:00
+        stop: 20:00
+envs:
+  test-env:
+    namespaces:
+      - test-namespace
+    schedule: main
+"""
+
+
+def test_state_store_round_trip(tmp_path):
+    config = Config(**yaml.safe_load(CONFIG))
+    now = datetime.datetime.now(tz=pytz.UTC)
+    action = Action(action_type=ActionType.START, action_date_type=ActionDateType.MANUAL, datetime=now)
+
+    store = StateStore(str(tmp_path / "state.sqlite"))
+    store.save_queue("test-env", config.schedules["main"], deque([action]), now)
+    store.action_started("test-env", action, deque())
+    store.close()
+
+    stored = StateStore(str(tmp_path / "state.sqlite")).load("test-env")
+    assert stored is not None
+    assert stored.action_queue == []
+    assert stored.action_in_progress == action
+    assert stored.last_action is None
+    assert stored.next_queue_recalculation_date == now
+
+
+def test_register_env_catches_up_missed_action(tmp_path):
+    config = Config(**yaml.safe_load(CONFIG))
+    schedule = config.schedules["main"]
+    now = datetime.datetime.now(tz=pytz.UTC)
+    missed = Action(
+        action_type=ActionType.STOP,
+        action_date_type=ActionDateType.WEEKDAY,
+        datetime=now - datetime.timedelta(hours=1),
+    )
+    too_old = Action(
+        action_type=ActionType.START,
+        action_date_type=ActionDateType.WEEKDAY,
+        datetime=now - datetime.timedelta(days=2),
+    )
+
+    store = StateStore(str(tmp_path / "state.sqlite"))
+    store.save_queue("test-env", schedule, deque([too_old, missed]), now + datetime.timedelta(days=1))
+
+    scheduler._reset_all_env_controllers()
+    scheduler.set_state_store(store, catch_up_window=datetime.timedelta(days=1))
+    try:
+        env_controller = scheduler.register_env(config.envs["test-env"], "test-env", schedule)
+        assert env_controller.action_queue[0] == missed
+        assert all(action.datetime >= now for action in list(env_controller.action_queue)[1:])
+        assert env_controller.next_queue_recalculation_date == now + datetime.timedelta(days=1)
+    finally:
+        scheduler._reset_all_env_controllers()
+
+
+def test_ready_by_starts_environment_ahead_of_schedule(tmp_path):
+    config = Config(**yaml.safe_load(CONFIG))
+    env = config.envs["test-env"].copy(update={"ready_by": True, "ready_by_max_lead": 3600})
+    store = StateStore(str(tmp_path / "state.sqlite"))
+    store.save_ready_estimate("test-env", 600)
+
+    scheduler._reset_all_env_controllers()
+    scheduler.set_state_store(store)
+    try:
+        env_controller = scheduler.register_env(env, "test-env", config.schedules["main"])
+        assert env_controller.ready_estimate == 600
+        head = env_controller.action_queue[0]
+        lead = datetime.timedelta(seconds=600) if head.action_type == ActionType.START else datetime.timedelta(0)
+        assert env_controller.armed_at == head.datetime - lead
+
+        start = next(action for action in env_controller.action_queue if action.action_type == ActionType.START)
+        assert scheduler._prewarm_lead(env_controller, start) == datetime.timedelta(seconds=600)
+        manual = start.copy(update={"action_date_type": ActionDateType.MANUAL})
+        assert scheduler._prewarm_lead(env_controller, manual) == datetime.timedelta(0)
+    finally:
+        scheduler._reset_all_env_controllers()
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.asyncio
+async def test_failed_write_does_not_leave_action_in_progress(tmp_path, monkeypatch):
+    config = Config(**yaml.safe_load(CONFIG))
+    store = StateStore(str(tmp_path / "state.sqlite"))
+    failures = [sqlite3.OperationalError("disk I/O error")]
+
+    def action_started(*args):
+        if failures:
+            raise failures.pop()
+
+    monkeypatch.setattr(store, "action_started", action_started)
+
+    async def mock_up(namespaces: list, *args, **kwargs) -> None:
+        pass
+
+    monkeypatch.setattr(scheduler, "up", mock_up)
+
+    scheduler._reset_all_env_controllers()
+    scheduler.set_state_store(store)
+    try:
+        scheduler.register_env(config.envs["test-env"], "test-env", config.schedules["main"])
+        env_controller = scheduler._env_controllers["test-env"]
+        queue = list(env_controller.action_queue)
+
+        with pytest.raises(sqlite3.OperationalError):
+            await scheduler.add_manual_action_to_queue("test-env", ActionType.START)
+        assert env_controller.env_state == scheduler.EnvControllerState.IDLE
+        assert list(env_controller.action_queue) == queue
+
+        await scheduler.add_manual_action_to_queue("test-env", ActionType.START)
+        await env_controller.executor
+        assert env_controller.env_state == scheduler.EnvControllerState.IDLE
+    finally:
+        scheduler._reset_all_env_controllers()
@@ -0,0 +1,98 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from nsscheduler import state_stream
+from nsscheduler.data_models.api import (
+    EnvironmentState,
+    EnvStateResponse,
+    NamespaceStateResponse,
+)
+from nsscheduler.data_models.internal import NamespaceState
+from nsscheduler.state_stream import StateBroadcaster, StateVersions
+
+
+def make_response(env_name: str, pods: int) -> EnvStateResponse:
+    return EnvStateResponse(
+        env_name=env_name,
+        env_state=EnvironmentState.UP if pods else EnvironmentState.DOWN,
+        schedule_name="main",
+        next_action=None,
+        namespaces=[NamespaceStateResponse(namespace_name="ns", state=NamespaceState(pods=pods, cpu=0, memory=0))],
+    )
+
+
+@pytest.mark.asyncio
+async def test_only_changed_environments_are_pushed():
+    pods = {"env-1": 0, "env-2": 0}
+    computed = []
+
+    async def get_states():
+        computed.append(dict(pods))
+        return SimpleNamespace(environments=[make_response(name, count) for name, count in pods.items()])
+
+    broadcaster = StateBroadcaster(get_states, StateVersions(), interval=0.01, keepalive=0.2)
+    first, second = broadcaster.subscribe(), broadcaster.subscribe()
+
+    def env_names(payloads: list[bytes]) -> list[str]:
+        return [json.loads(payload)["env_name"] for payload in payloads]
+
+    assert env_names(await first.__anext__()) == ["env-1", "env-2"]
+    # The second subscriber joins while the states are already known
+    assert env_names(await second.__anext__()) == ["env-1", "env-2"]
+
+    pods["env-2"] = 3
+    assert env_names(await asyncio.wait_for(first.__anext__(), 1)) == ["env-2"]
+    assert env_names(await asyncio.wait_for(second.__anext__(), 1)) == ["env-2"]
+    # Nothing has changed, only a keepalive follows
+    assert await asyncio.wait_for(first.__anext__(), 1) == []
+
+    await first.aclose()
+    await second.aclose()
+    await asyncio.sleep(0.05)
+    # States are not computed without subscribers
+    computed_count = len(computed)
+    await asyncio.sleep(0.05)
+    assert len(computed) == computed_count
+
+
+def test_states_are_encoded_only_when_changed(monkeypatch):
+    encoded = []
+
+    def encode_json(obj):
+        encoded.append(obj["env_name"])
+        return json.dumps(obj, default=str).encode()
+
+    monkeypatch.setattr(state_stream, "encode_json", encode_json)
+
+    versions = StateVersions()
+    first_version = versions.update([make_response("env-1", 0), make_response("env-2", 0)])
+    assert encoded == ["env-1", "env-2"]
+
+    assert versions.update([make_response("env-1", 0), make_response("env-2", 0)]) == first_version
+    assert encoded == ["env-1", "env-2"]
+
+    states = [make_response("env-1", 0), make_response("env-2", 1)]
+    assert versions.update(states) == first_version + 1
+    assert encoded == ["env-1", "env-2", "env-2"]
+    assert [state.version for state in states] == [first_version - 1, first_version + 1]
+    assert json.loads(versions.payload("env-2"))["version"] == first_version + 1
+
+
+@pytest.mark.asyncio
+async def test_streamed_states_share_versions():
+    async def get_states():
+        return SimpleNamespace(environments=[make_response("env-1", 1)])
+
+    versions = StateVersions()
+    versions.update([make_response("env-1", 1)])
+    broadcaster = StateBroadcaster(get_states, versions, interval=0.01)
+    subscription = broadcaster.subscribe()
+
+    streamed = await asyncio.wait_for(subscription.__anext__(), 1)
+    # The state has not changed since it was served by another endpoint, so it is streamed with the same version
+    assert streamed == [versions.payload("env-1")]
+    assert json.loads(streamed[0])["version"] > 0
+    await subscription.aclose()
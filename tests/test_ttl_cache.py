@@ -0,0 +1,22 @@
+import time
+
+from nsscheduler.ttl_cache import CacheStats, TTLCache
+
+
+def test_entries_expire_and_are_evicted():
+    cache = TTLCache(ttl=0.05, maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" is the least recently used one
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+    time.sleep(0.06)
+    assert cache.get("c") is None
+    assert len(cache) == 0
+    assert cache.stats() == CacheStats(hits=1, misses=3, evictions=1, invalidations=1)
@@ -0,0 +1,201 @@
+import asyncio
+import threading
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+from nsscheduler import updown
+from nsscheduler.data_models.scheduler_config import BatchConfig
+from nsscheduler.dependencies import (
+    DependencyCycleException,
+    WorkloadNode,
+    build_dependency_graph,
+    depends_on_annotation,
+    tier_annotation,
+)
+
+
+def make_workload(namespace: str, name: str, replicas: int = 0) -> SimpleNamespace:
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            namespace=namespace, name=name, generation=1, annotations={updown.updown_annotation: "1"}
+        ),
+        spec=SimpleNamespace(replicas=replicas),
+    )
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    """Fake cluster: {namespace: (deployments, stateful_sets)}. Patches are recorded to `cluster.patched`."""
+    workloads = {
+        "ns-data": ([], [make_workload("ns-data", "db-1"), make_workload("ns-data", "db-2")]),
+        "ns-apps": ([make_workload("ns-apps", "app-1"), make_workload("ns-apps", "app-2")], []),
+    }
+    patched = []
+
+    def updater(name, namespace, body, pretty):
+        patched.append(f"{namespace}/{name}")
+        return SimpleNamespace(
+            metadata=SimpleNamespace(generation=2), spec=SimpleNamespace(replicas=body["spec"]["replicas"])
+        )
+
+    monkeypatch.setattr(updown, "list_namespaces", lambda: list(workloads))
+    monkeypatch.setattr(updown, "list_workloads", lambda ns: workloads[ns])
+    monkeypatch.setattr(
+        updown.kubernetes.client,
+        "AppsV1Api",
+        lambda: SimpleNamespace(patch_namespaced_deployment=updater, patch_namespaced_stateful_set=updater),
+    )
+    return SimpleNamespace(workloads=workloads, patched=patched)
+
+
+@pytest.mark.asyncio
+async def test_up_skips_workloads_completed_by_previous_run(cluster):
+    recorded = []
+    journal = updown.ActionJournal(
+        completed={"StatefulSet/ns-data/db-1", "StatefulSet/ns-data/db-2"}, on_completed=recorded.append
+    )
+
+    await updown.up(["ns-data", "ns-apps"], journal=journal)
+
+    assert cluster.patched == ["ns-apps/app-1", "ns-apps/app-2"]
+    assert recorded == ["Deployment/ns-apps/app-1", "Deployment/ns-apps/app-2"]
+
+
+@pytest.mark.asyncio
+async def test_up_does_not_block_event_loop(cluster, monkeypatch):
+    # Patches block until the event loop releases them, which would never happen if they ran on the loop itself
+    released = threading.Event()
+    waits = []
+
+    def updater(name, namespace, body, pretty):
+        waits.append(released.wait(5))
+        return SimpleNamespace(metadata=SimpleNamespace(generation=2), spec=SimpleNamespace(replicas=1))
+
+    monkeypatch.setattr(
+        updown.kubernetes.client,
+        "AppsV1Api",
+        lambda: SimpleNamespace(patch_namespaced_deployment=updater, patch_namespaced_stateful_set=updater),
+    )
+
+    task = asyncio.create_task(updown.up(["ns-data", "ns-apps"], concurrency=4))
+    await asyncio.sleep(0.1)
+    released.set()
+    await task
+
+    assert waits == [True] * 4
+
+
+@pytest.mark.asyncio
+async def test_tiers_follow_namespace_order(cluster):
+    await updown.up(["ns-data", "ns-apps"], concurrency=4)
+    assert cluster.patched[:2] == ["ns-data/db-1", "ns-data/db-2"]
+    assert sorted(cluster.patched[2:]) == ["ns-apps/app-1", "ns-apps/app-2"]
+
+    for deployments, stateful_sets in cluster.workloads.values():
+        for workload in deployments + stateful_sets:
+            workload.spec.replicas = 1
+    cluster.patched.clear()
+
+    await updown.down(["ns-data", "ns-apps"], concurrency=4)
+    assert sorted(cluster.patched[:2]) == ["ns-apps/app-1", "ns-apps/app-2"]
+    assert sorted(cluster.patched[2:]) == ["ns-data/db-1", "ns-data/db-2"]
+
+
+def test_build_dependency_graph():
+    nodes = [
+        WorkloadNode("StatefulSet/data/db", "data", "db", {tier_annotation: "0"}),
+        WorkloadNode("Deployment/data/cache", "data", "cache", {}),
+        WorkloadNode("Deployment/apps/api", "apps", "api", {tier_annotation: "1"}),
+        WorkloadNode("Deployment/apps/web", "apps", "web", {tier_annotation: "1", depends_on_annotation: "api"}),
+    ]
+    assert build_dependency_graph(nodes) == {
+        "StatefulSet/data/db": set(),
+        "Deployment/data/cache": set(),
+        "Deployment/apps/api": {"StatefulSet/data/db", "Deployment/data/cache"},
+        "Deployment/apps/web": {"StatefulSet/data/db", "Deployment/data/cache", "Deployment/apps/api"},
+    }
+
+    nodes[0].annotations[depends_on_annotation] = "apps/web"
+    with pytest.raises(DependencyCycleException):
+        build_dependency_graph(nodes)
+
+
+def make_status(generation: int, replicas: int, ready_replicas: int) -> SimpleNamespace:
+    """Workload as seen by get_workload"""
+    return SimpleNamespace(
+        metadata=SimpleNamespace(generation=generation),
+        spec=SimpleNamespace(replicas=replicas),
+        status=SimpleNamespace(observed_generation=generation, ready_replicas=ready_replicas),
+    )
+
+
+@pytest.mark.asyncio
+async def test_up_starts_workloads_once_dependencies_are_ready(cluster, monkeypatch):
+    # app-1 and app-2 depend on both databases. The first polls see the databases as they were before the patch (like a
+    # store of an informer, which has not observed it yet), then they are scaled but not ready, then ready
+    for deployment in cluster.workloads["ns-apps"][0]:
+        deployment.metadata.annotations[tier_annotation] = "1"
+    polls = []
+
+    def get_workload(kind, namespace, name):
+        polls.append(list(cluster.patched))
+        if len(polls) <= 2:
+            return make_status(generation=1, replicas=0, ready_replicas=0)
+        return make_status(generation=2, replicas=1, ready_replicas=1 if len(polls) > 4 else 0)
+
+    monkeypatch.setattr(updown, "get_workload", get_workload)
+    monkeypatch.setattr(updown, "ready_poll_period", 0)
+
+    await updown.up(["ns-apps", "ns-data"], concurrency=4)
+
+    assert sorted(cluster.patched[:2]) == ["ns-data/db-1", "ns-data/db-2"]
+    assert sorted(cluster.patched[2:]) == ["ns-apps/app-1", "ns-apps/app-2"]
+    assert len(polls) > 4
+    assert all(len(patched) == 2 for patched in polls)
+
+
+@pytest.mark.asyncio
+async def test_readiness_gated_batches_do_not_wait_for_timeout(cluster, monkeypatch):
+    # Every workload is first seen as it was before the patch, then ready
+    polls = {}
+
+    def get_workload(kind, namespace, name):
+        polls.setdefault(f"{namespace}/{name}", []).append(list(cluster.patched))
+        if len(polls[f"{namespace}/{name}"]) == 1:
+            return make_status(generation=1, replicas=0, ready_replicas=0)
+        return make_status(generation=2, replicas=1, ready_replicas=1)
+
+    monkeypatch.setattr(updown, "get_workload", get_workload)
+    monkeypatch.setattr(updown, "ready_poll_period", 0)
+
+    await asyncio.wait_for(
+        updown.up(["ns-data", "ns-apps"], batch_size=1, batch_timeout=3600, batch_until_ready=True), timeout=5
+    )
+
+    assert cluster.patched == ["ns-data/db-1", "ns-data/db-2", "ns-apps/app-1", "ns-apps/app-2"]
+    # The next batch is started only after the previous one was seen scaled and ready
+    assert polls["ns-data/db-1"] == [["ns-data/db-1"], ["ns-data/db-1"]]
+    assert polls["ns-apps/app-1"] == [["ns-data/db-1", "ns-data/db-2", "ns-apps/app-1"]] * 2
+
+
+def test_split_batches_by_resource_budget():
+    def planned(name: str, cpu: str, replicas: int = 2):
+        workload = make_workload("ns", name)
+        workload.metadata.annotations[updown.updown_annotation] = str(replicas)
+        workload.spec.template = SimpleNamespace(
+            spec=SimpleNamespace(containers=[SimpleNamespace(resources=SimpleNamespace(requests={"cpu": cpu}))])
+        )
+        return updown.PlannedWorkload("Deployment", workload, None)
+
+    # 2 replicas each: 1, 1, 8 and 0.5 cores
+    workloads = [planned("a", "500m"), planned("b", "500m"), planned("c", "4"), planned("d", "250m")]
+    batches = updown.split_batches(workloads, cpu=BatchConfig(timeout=60, cpu="4").cpu)
+    assert [[p.workload.metadata.name for p in batch] for batch in batches] == [["a", "b"], ["c"], ["d"]]
+
+    batches = updown.split_batches(workloads, size=1, cpu=Decimal(100))
+    assert len(batches) == 4
+
+    with pytest.raises(ValueError):
+        BatchConfig(timeout=60)